@@ -0,0 +1,86 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import importlib.util
+from time import time
+from itertools import groupby, chain
+from miqsar.descriptor_calculation.read_input import read_input
+from miqsar.descriptor_calculation.pmapper import pharmacophore as P
+
+smarts_fname = os.path.join(os.path.dirname(os.path.abspath(P.__file__)), 'smarts_features.txt')
+
+
+def load_module(fname):
+    # another revision of pharmacophore.py, e.g. from git show <rev>:miqsar/descriptor_calculation/pmapper/pharmacophore.py
+    spec = importlib.util.spec_from_file_location('pharmacophore_ref', fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_confs(fname, n_mols):
+    # conformers of a pkl made by gen_conformers are consecutive (mol, mol_title, act, mol_id) records
+    confs = []
+    for i, (mol_id, group) in enumerate(groupby(read_input(fname), key=lambda x: x[3])):
+        if i == n_mols:
+            break
+        confs.append([m[0] for m in group])
+    return confs
+
+
+def time_descriptors(module, confs, smarts, n_repeat, shared_cache=False):
+    # shared_cache: conformers of a molecule share a SignatureCache as in pmapper_3d
+    start = time()
+    for _ in range(n_repeat):
+        res, caches = [], []
+        for mol_confs in confs:
+            kwargs = {}
+            if shared_cache:
+                caches.append(module.SignatureCache())
+                kwargs['signature_cache'] = caches[-1]
+            for mol in mol_confs:
+                p = module.Pharmacophore(**kwargs)
+                p.load_from_smarts(mol, smarts)
+                res.append(p.get_descriptors())
+    hits = sum(c.hits for c in caches)
+    misses = sum(c.misses for c in caches)
+    return (time() - start) / n_repeat / len(res), res, hits / (hits + misses) if caches else None
+
+
+def main(fname, n_mols, n_repeat, ref):
+    smarts = P.read_smarts_feature_file(smarts_fname)
+    confs = read_confs(fname, n_mols)
+    n_confs, n_features = 0, 0
+    for mol in chain.from_iterable(confs):
+        p = P.Pharmacophore()
+        p.load_from_smarts(mol, smarts)
+        n_confs += 1
+        n_features += len(p.get_feature_coords())
+    print('molecules: {}, conformers: {}, features per conformer: {:.1f}'.format(len(confs), n_confs,
+                                                                                n_features / n_confs))
+
+    sec, res, _ = time_descriptors(P, confs, smarts, n_repeat)
+    print('current\t{:.2f} ms/conformer'.format(sec * 1000))
+    shared_sec, shared_res, hit_rate = time_descriptors(P, confs, smarts, n_repeat, shared_cache=True)
+    print('shared cache\t{:.2f} ms/conformer, hit rate {:.2f}, identical descriptors: {}'.format(
+        shared_sec * 1000, hit_rate, shared_res == res))
+    if ref is not None:
+        ref_sec, ref_res, _ = time_descriptors(load_module(ref), confs, smarts, n_repeat)
+        print('ref\t{:.2f} ms/conformer'.format(ref_sec * 1000))
+        print('speedup\t{:.2f}x, identical descriptors: {}'.format(ref_sec / min(sec, shared_sec), ref_res == res))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time of pmapper 3D descriptors per conformer',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', metavar='conf.pkl', required=True,
+                        help='multi-conformer pickle made by gen_conformers')
+    parser.add_argument('-m', '--n_mols', metavar='num', default=50, type=int, help='number of molecules to use')
+    parser.add_argument('-r', '--repeat', metavar='num', default=3, type=int, help='number of timed runs')
+    parser.add_argument('--ref', metavar='pharmacophore.py', default=None,
+                        help='another version of pharmacophore.py to compare with')
+
+    args = parser.parse_args()
+    main(args.input, args.n_mols, args.repeat, args.ref)
@@ -0,0 +1,131 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import pickle
+import torch
+import numpy as np
+from time import time
+from miqsar.descriptor_calculation.descriptor_store import read_descriptors, store_exists, META_COLS
+from miqsar.estimators.neural_nets.attention_nets import SelfAttention, SelfAttentionNetRegressor
+from miqsar.estimators.neural_nets.utils import PackedBags, BucketBatchSampler, set_seed
+
+# batches of the compared modes: n_buckets of BucketBatchSampler
+#   padded - one bucket, every shuffled batch is padded to its largest bag (with ragged bags this is close
+#            to padding to the largest bag of the dataset)
+#   bucketed - bags of similar size are batched together
+#   varlen - one bucket per bag size, batches have no padding and SelfAttention skips the mask
+MODES = [('padded', 1), ('bucketed', 8), ('varlen', None)]
+
+
+def conf_energies(fname):
+    # energy of every conformer relative to the lowest one of its molecule, from the log file of gen_confs
+    energies = {}
+    with open(fname, 'rb') as f:
+        while True:
+            try:
+                confs = pickle.load(f)
+            except EOFError:
+                break
+            e_min = min(c[4] for c in confs)
+            energies.update((c[1], c[4] - e_min) for c in confs)
+    return energies
+
+
+def load_bags(fname, energies=None, energy=None):
+    # the descriptor store or the csv written by dsc_calc/run.py, one bag per mol_id,
+    # conformers higher than energy above the lowest one are dropped if energies are given
+    data = read_descriptors(fname)
+    if energies is not None and energy is not None:
+        data = data[[energies.get(i, np.inf) <= energy for i in data['mol_title']]]
+    ids = data['mol_id'].str.upper().to_numpy(dtype=str)
+    order = np.argsort(ids, kind='stable')
+    _, starts = np.unique(ids[order], return_index=True)
+    x = data.drop(META_COLS, axis=1).to_numpy(dtype='float32')[order]
+    labels = data['act'].to_numpy(dtype='float64')[order[starts]]
+    return PackedBags(x, np.append(starts, len(order))), labels
+
+
+def time_fit(bags, labels, n_buckets, batch_size, n_epoch):
+    set_seed(42)
+    net = SelfAttentionNetRegressor(ndim=(bags.n_dim, 256, 128, 64), det_ndim=(64,))
+    start = time()
+    net.fit(bags, labels, n_epoch=n_epoch, batch_size=batch_size, n_buckets=n_buckets)
+    return (time() - start) / n_epoch, net.padding_waste
+
+
+def time_attention(bags, n_buckets, batch_size, fused, n_repeat, dim=64):
+    # forward and backward of a SelfAttention layer over the batches of one epoch, features of instances
+    # are random dim-sized vectors as the main net gives them, only the shapes of batches matter
+    set_seed(42)
+    att = SelfAttention(dim, dim, fused=fused)
+    sampler = BucketBatchSampler(bags, batch_size=batch_size, n_buckets=n_buckets, shuffle=False)
+    batches = []
+    for idx in sampler:
+        _, m = bags.pad(idx)
+        m = torch.from_numpy(m)
+        batches.append((torch.randn(m.shape[0], m.shape[1], dim) * m, m))
+
+    start = time()
+    for _ in range(n_repeat):
+        for x, m in batches:
+            att(x.requires_grad_(), m).sum().backward()
+    return (time() - start) / n_repeat, sampler.padding_waste
+
+
+def main(datasets_dir, dsc_dir, n_conf, energy, batch_size, n_epoch, n_repeat):
+    results = []
+    for dataset in sorted(os.listdir(datasets_dir)):
+        dataset = dataset.split('.')[0]
+        fname = os.path.join(dsc_dir, dataset, 'PhFprPmapper_conf-{}_{}.csv'.format(dataset, n_conf))
+        if not (store_exists(fname) or os.path.exists(fname)):
+            print('{}\tno descriptors: {}'.format(dataset, fname))
+            continue
+        log_fname = os.path.join(dsc_dir, dataset, 'conf-{}_{}_log.pkl'.format(n_conf, dataset))
+        energies = conf_energies(log_fname) if energy is not None and os.path.exists(log_fname) else None
+        bags, labels = load_bags(fname, energies, energy)
+        results.append((dataset, bags, labels))
+        print('{}: {} bags, bag size min {} median {:.0f} max {}{}'.format(
+            dataset, len(bags), bags.sizes.min(), np.median(bags.sizes), bags.sizes.max(),
+            '' if energies is None else ', conformers within {} kcal/mol'.format(energy)))
+
+    print('\nSelfAttentionNetRegressor.fit')
+    print('dataset\tmode\tepoch_sec\tpadding_waste\tspeedup')
+    for dataset, bags, labels in results:
+        # not timed, the first fit pays for the allocator and kernel initialization
+        time_fit(bags, labels, 1, batch_size, 1)
+        times = [time_fit(bags, labels, n_buckets, batch_size, n_epoch) for mode, n_buckets in MODES]
+        for (mode, _), (epoch_time, waste) in zip(MODES, times):
+            print('{}\t{}\t{:.3f}\t{:.3f}\t{:.2f}'.format(dataset, mode, epoch_time, waste, times[0][0] / epoch_time))
+
+    # masked: padded batches with the attention mask, unmasked: varlen batches, m.all() skips the mask
+    print('\nSelfAttention forward and backward per epoch')
+    print('dataset\tkernel\tmasked_ms\tunmasked_ms\tspeedup')
+    for dataset, bags, labels in results:
+        for fused in (True, False):
+            t_masked, _ = time_attention(bags, 1, batch_size, fused, n_repeat)
+            t_unmasked, _ = time_attention(bags, None, batch_size, fused, n_repeat)
+            print('{}\t{}\t{:.1f}\t{:.1f}\t{:.2f}'.format(dataset, 'fused' if fused else 'matmul', t_masked * 1000,
+                                                          t_unmasked * 1000, t_masked / t_unmasked))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SelfAttentionNet epoch time with padded, bucketed and varlen '
+                                                 'batches and masked against unmasked SelfAttention '
+                                                 'on the chiral datasets',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--datasets', metavar='dir', default='datasets/chiral', help='dir with smi datasets')
+    parser.add_argument('-d', '--dsc_dir', metavar='dir', default='descriptors',
+                        help='descriptors dir made by dsc_calc/run.py')
+    parser.add_argument('-c', '--n_conf', metavar='num', default=100, type=int, help='max conformers per molecule')
+    parser.add_argument('-E', '--energy', metavar='kcal/mol', default=10, type=float,
+                        help='keep conformers within this energy window of the lowest one (from the conformer log '
+                             'file) to get ragged bags, negative keeps all conformers')
+    parser.add_argument('-b', '--batch_size', metavar='num', default=128, type=int, help='bags per batch')
+    parser.add_argument('-e', '--n_epoch', metavar='num', default=5, type=int, help='epochs to time')
+    parser.add_argument('-r', '--repeat', metavar='num', default=5, type=int, help='repeats of SelfAttention epochs')
+
+    args = parser.parse_args()
+    main(args.datasets, args.dsc_dir, args.n_conf, args.energy if args.energy >= 0 else None, args.batch_size,
+         args.n_epoch, args.repeat)
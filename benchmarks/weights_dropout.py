@@ -0,0 +1,55 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import torch
+from time import time
+from torch.nn import Softmax
+from miqsar.estimators.neural_nets.attention_nets import WeightsDropout
+
+
+def legacy_weights_dropout(w, p):
+    # list-indexing implementation WeightsDropout replaced, kept for comparison
+    d0 = [[i] for i in range(len(w))]
+    d1 = w.argsort(dim=2)[:, :, :int(w.shape[2] * p)]
+    d1 = [i.reshape(1, -1)[0].tolist() for i in d1]
+    w_new = w.clone()
+    w_new[d0, :, d1] = 0
+    d1 = [i[0].nonzero().flatten().tolist() for i in w_new]
+    w_new[d0, :, d1] = Softmax(dim=1)(w_new[d0, :, d1])
+    return w_new
+
+
+def step_time(func, w, n_repeat):
+    start = time()
+    for _ in range(n_repeat):
+        w_grad = w.clone().requires_grad_()
+        out = func(w_grad)
+        (out * w).sum().backward()
+    return (time() - start) / n_repeat
+
+
+def main(bag_sizes, batch_size, p, n_repeat):
+    print('bag_size\tlegacy_ms\tvectorized_ms\tspeedup\tmax_abs_diff')
+    for bag_size in bag_sizes:
+        w = Softmax(dim=2)(torch.randn(batch_size, 1, bag_size))
+        vectorized = WeightsDropout(p=p)
+        diff = (vectorized(w) - legacy_weights_dropout(w, p)).abs().max().item()
+
+        t_legacy = step_time(lambda x: legacy_weights_dropout(x, p), w, n_repeat)
+        t_new = step_time(vectorized, w, n_repeat)
+        print('{}\t{:.3f}\t{:.3f}\t{:.1f}\t{:.2e}'.format(bag_size, t_legacy * 1000, t_new * 1000, t_legacy / t_new, diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Step time of WeightsDropout against the list-indexing version',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--bag_sizes', metavar='N', nargs='+', type=int,
+                        default=[1, 2, 5, 10, 20, 50, 100, 200, 500], help='bag sizes to benchmark')
+    parser.add_argument('-b', '--batch_size', metavar='num', default=128, type=int, help='bags per batch')
+    parser.add_argument('-p', '--dropout', metavar='p', default=0.5, type=float, help='share of dropped weights')
+    parser.add_argument('-r', '--repeat', metavar='num', default=20, type=int, help='repeats per bag size')
+
+    args = parser.parse_args()
+    main(args.bag_sizes, args.batch_size, args.dropout, args.repeat)
@@ -4,32 +4,32 @@ sys.path.append('/home/zankov/dev/miqsar')
 import os
 import shutil
 from multiprocessing import Pool
-from sklearn.model_selection import train_test_split
-from utils import (DataReader, ModelBuilder, scale_data, ti_train_test_split_scaffold,
+from utils import (DataReader, ModelBuilder, scale_data, train_test_split_bags, ti_train_test_split_scaffold,
                    pg_train_test_split_scaffold)
 
 RANDOM_STATE = 45
 DATA_DIR = 'descriptors'
 OUT_DIR = 'models'
+RESUME = False  # keep OUT_DIR and skip the tuning trials already logged there
+N_JOBS = 1  # tuning trials trained in parallel, datasets then run one by one
+N_THREADS = None  # torch threads of every trial process, None keeps the torch default
 MAX_CONF = 100
 INIT_CUDA = False
 DATASETS_PATH = 'datasets'
 TRAIN_TEST_SPLIT_FUNCTION = pg_train_test_split_scaffold
 DATASETS_TO_MODEL = open("datasets_to_model.txt", "r").read().split(',')
 
-if os.path.exists(OUT_DIR):
+if os.path.exists(OUT_DIR) and not RESUME:
    shutil.rmtree(OUT_DIR)
-   os.mkdir(OUT_DIR)
-else:
-   os.mkdir(OUT_DIR)
+os.makedirs(OUT_DIR, exist_ok=True)
 
 
 def run(dataset):
     if dataset not in DATASETS_TO_MODEL:
         return
-    os.mkdir(os.path.join(OUT_DIR, dataset))
+    os.makedirs(os.path.join(OUT_DIR, dataset), exist_ok=True)
 
-    data_reader = DataReader(DATA_DIR, dataset)
+    data_reader = DataReader(DATA_DIR, dataset, verbose=True)
     data = data_reader.read_3d(DATA_DIR, MAX_CONF)
 
     for dsc in ['pmapper']:
@@ -38,25 +38,25 @@ def run(dataset):
         bags, labels, idx = data['dsc']['3d_{}'.format(dsc)][MAX_CONF], data['labels'], data['idx']
         x_train, x_test, y_train, y_test, idx_train, idx_test = TRAIN_TEST_SPLIT_FUNCTION(DATASETS_PATH, '{}.smi'.format(dataset), bags, labels, idx,
                                                                                           random_state=RANDOM_STATE)
-        x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split(x_train, y_train, idx_train, test_size=0.25,
-                                                                              random_state=RANDOM_STATE)
+        x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split_bags(x_train, y_train, idx_train, test_size=0.25,
+                                                                                   random_state=RANDOM_STATE)
         _, x_test = scale_data(x_train, x_test)
         x_train, x_val = scale_data(x_train, x_val)
 
-        model_builder = ModelBuilder(init_cuda=INIT_CUDA)
+        model_builder = ModelBuilder(init_cuda=INIT_CUDA, n_jobs=N_JOBS, n_threads=N_THREADS)
         model_builder.local_dir = os.path.join(OUT_DIR, dataset)
         nets_default, nets_tuned = model_builder.tune_nets(x_train, x_val, y_train, y_val)
 
         # 3d build
         for n_conf in [1, MAX_CONF]:
             model_builder.local_dir = os.path.join(OUT_DIR, dataset, '{}_{}'.format(dsc, n_conf))
-            os.mkdir(model_builder.local_dir)
+            os.makedirs(model_builder.local_dir, exist_ok=True)
             #
             data = data_reader.read_3d(DATA_DIR, n_conf)
             bags, labels, idx = data['dsc']['3d_{}'.format(dsc)][n_conf], data['labels'], data['idx']
             x_train, x_test, y_train, y_test, idx_train, idx_test = TRAIN_TEST_SPLIT_FUNCTION(DATASETS_PATH, '{}.smi'.format(dataset), bags, labels, idx,
                                                                                               random_state=RANDOM_STATE)
-            x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split(x_train, y_train, idx_train, test_size=0.25, random_state=RANDOM_STATE)
+            x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split_bags(x_train, y_train, idx_train, test_size=0.25, random_state=RANDOM_STATE)
             _, x_test = scale_data(x_train, x_test)
             x_train, x_val = scale_data(x_train, x_val)
             #
@@ -66,14 +66,14 @@ def run(dataset):
     # 2d tune and build
     data = data_reader.read_2d(DATA_DIR)
     for dsc in data['dsc']['2d']:
-        model_builder = ModelBuilder(init_cuda=INIT_CUDA)
+        model_builder = ModelBuilder(init_cuda=INIT_CUDA, n_jobs=N_JOBS, n_threads=N_THREADS)
         model_builder.local_dir = os.path.join(OUT_DIR, dataset, '{}_0'.format(dsc))
-        os.mkdir(model_builder.local_dir)
+        os.makedirs(model_builder.local_dir, exist_ok=True)
         #
         bags, labels, idx = data['dsc']['2d'][dsc], data['labels'], data['idx']
         x_train, x_test, y_train, y_test, idx_train, idx_test = TRAIN_TEST_SPLIT_FUNCTION(DATASETS_PATH, '{}.smi'.format(dataset), bags, labels, idx,
                                                                                           random_state=RANDOM_STATE)
-        x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split(x_train, y_train, idx_train, test_size=0.25, random_state=RANDOM_STATE)
+        x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split_bags(x_train, y_train, idx_train, test_size=0.25, random_state=RANDOM_STATE)
         _, x_test = scale_data(x_train, x_test)
         x_train, x_val = scale_data(x_train, x_val)
         #
@@ -86,5 +86,10 @@ def run(dataset):
 
 datasets = os.listdir(DATA_DIR)
 if __name__ == '__main__':
-    with Pool(len(datasets)) as p:
-        p.map(run, datasets, chunksize=1)
\ No newline at end of file
+    # daemonic Pool workers can't start the Pool of the tuner
+    if N_JOBS > 1:
+        for dataset in datasets:
+            run(dataset)
+    else:
+        with Pool(len(datasets)) as p:
+            p.map(run, datasets, chunksize=1)
\ No newline at end of file
@@ -49,28 +49,28 @@ NCPU = 15
 INP_DIR = 'datasets'
 OUT_DIR = 'descriptors'
 NCONFS_LIST = [1, 100]
+DSC_FORMAT = 'npy'  # csv or npy descriptor store
+RESUME = False  # keep conformers of an interrupted run and generate only missing ones
 
 for chembl in os.listdir(INP_DIR):
 
     dsc_dir = os.path.join(OUT_DIR, chembl.split('.')[0])
 
-    if os.path.exists(dsc_dir):
+    if os.path.exists(dsc_dir) and not RESUME:
         shutil.rmtree(dsc_dir)
-        os.mkdir(dsc_dir)
-    else:
-        os.mkdir(dsc_dir)
+    os.makedirs(dsc_dir, exist_ok=True)
 
     chembl = os.path.join(INP_DIR, chembl)
 
     # calc 2d
-    calc_2d_descriptors(fname=chembl, ncpu=NCPU, path=dsc_dir)
-    calc_ph_descriptors(fname=chembl, ncpu=NCPU, path=dsc_dir)
-    calc_morgan_descriptors(fname=chembl, path=dsc_dir)
+    calc_2d_descriptors(fname=chembl, ncpu=NCPU, path=dsc_dir, out_format=DSC_FORMAT)
+    calc_ph_descriptors(fname=chembl, ncpu=NCPU, path=dsc_dir, out_format='npz' if DSC_FORMAT == 'npy' else DSC_FORMAT)
+    calc_morgan_descriptors(fname=chembl, path=dsc_dir, out_format=DSC_FORMAT, ncpu=NCPU)
 
     # calc 3d
-    conf_files = gen_confs(chembl, nconfs_list=NCONFS_LIST, stereo=False, path=dsc_dir, ncpu=NCPU)
+    conf_files = gen_confs(chembl, nconfs_list=NCONFS_LIST, stereo=False, path=dsc_dir, ncpu=NCPU, resume=RESUME)
 
-    calc_3d_pmapper(conf_files, nconfs_list=NCONFS_LIST, stereo=False, ncpu=NCPU, path=dsc_dir)
-    calc_3d_rdkit(conf_files, nconfs_list=NCONFS_LIST, stereo=False, ncpu=NCPU, path=dsc_dir)
+    calc_3d_pmapper(conf_files, nconfs_list=NCONFS_LIST, stereo=False, ncpu=NCPU, path=dsc_dir, out_format=DSC_FORMAT)
+    calc_3d_rdkit(conf_files, nconfs_list=NCONFS_LIST, stereo=False, ncpu=NCPU, path=dsc_dir, out_format=DSC_FORMAT)
 
 
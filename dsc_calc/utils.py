@@ -1,11 +1,13 @@
 import sys
 sys.path.append('/home/zankov/dev/miqsar')
 
+import os
 import pickle
 import joblib
 import pandas as pd
 from miqsar.descriptor_calculation.rdkit_3d import calc_3d_descriptors
 from miqsar.descriptor_calculation.pmapper_3d import calc_pmapper_descriptors
+from miqsar.descriptor_calculation.descriptor_store import read_descriptors, write_frame
 
 
 def read_pkl(fname):
@@ -17,7 +19,7 @@ def read_pkl(fname):
                 break
 
 
-def calc_3d_rdkit(conf_files, nconfs_list=[1], stereo=False, path='.', ncpu=10):
+def calc_3d_rdkit(conf_files, nconfs_list=[1], stereo=False, path='.', ncpu=10, out_format='csv'):
 
     res = {}
     for file, n_conf in zip(conf_files, nconfs_list):
@@ -26,18 +28,19 @@ def calc_3d_rdkit(conf_files, nconfs_list=[1], stereo=False, path='.', ncpu=10):
         for _, conf, _, _ in confs:
             res[n_conf].append(conf)
 
-    dsc_file = calc_3d_descriptors(conf_files[-1], path=path, ncpu=ncpu, del_log=True)
+    dsc_file = calc_3d_descriptors(conf_files[-1], path=path, ncpu=ncpu, del_log=True, out_format=out_format)
 
+    data = read_descriptors(dsc_file)
+    data.index = data['mol_title']
+    ext = os.path.splitext(dsc_file)[1]
     for n_conf, idx in res.items():
-        data = pd.read_csv(dsc_file)
-        data.index = data['mol_title']
-        name = dsc_file.replace('_{}.csv'.format(max(nconfs_list)), '_{}.csv'.format(n_conf))
-        data.loc[idx].to_csv(name, index=False)
+        name = dsc_file.replace('_{}{}'.format(max(nconfs_list), ext), '_{}{}'.format(n_conf, ext))
+        write_frame(name, data.loc[idx], dtype='float32', out_format=out_format, index=False)
 
     return
 
 
-def calc_3d_pmapper(conf_files, nconfs_list=[1], stereo=False, path='.', ncpu=10):
+def calc_3d_pmapper(conf_files, nconfs_list=[1], stereo=False, path='.', ncpu=10, out_format='csv'):
 
     for conf in conf_files:
         dsc_file = calc_pmapper_descriptors(conf, path=path, ncpu=ncpu, col_clean=None, del_undef=True)
@@ -48,8 +51,7 @@ def calc_3d_pmapper(conf_files, nconfs_list=[1], stereo=False, path='.', ncpu=10
         if 'mol_title' not in data.columns:
             data = data.reset_index()
         data['mol_id'] = data['mol_id'].str.lower()
-        fname = dsc_file.split
-        data.to_csv(dsc_file.replace('_proc.pkl', '.csv'), index=False)
+        write_frame(dsc_file.replace('_proc.pkl', '.csv'), data, dtype='uint16', out_format=out_format, index=False)
 
     return
 
@@ -35,7 +35,7 @@ def get_n_confs(conf_log, nconf_list, out_partfname):
     return out_fnames
 
 
-def gen_confs(fname, nconfs_list, stereo=True, path=None, ncpu=4):
+def gen_confs(fname, nconfs_list, stereo=True, path=None, ncpu=4, resume=False):
     '''
 
     :param fname: smi file. Mol_name, smiles, act
@@ -43,6 +43,8 @@ def gen_confs(fname, nconfs_list, stereo=True, path=None, ncpu=4):
     :param stereo: bool. False if only compute 3D coordinates.
     :param path: out path. If None uses dirname of fname
     :param ncpu: int
+    :param resume: bool. Continue interrupted generation, molecules of the existing conformer log file are kept
+                   and the existing stereo-<fname> is not generated again.
     :return:
     '''
 
@@ -54,14 +56,17 @@ def gen_confs(fname, nconfs_list, stereo=True, path=None, ncpu=4):
     if stereo:
         #print('Stereo generation')
         in_fname = os.path.join(path, 'stereo-{}'.format(os.path.basename(fname)))
-        gen_stereo_rdkit.main_params(in_fname=fname,
-                                     out_fname=in_fname,
-                                     tetrahedral=True,
-                                     double_bond=True,
-                                     max_undef=-1,
-                                     id_field_name=None,
-                                     ncpu=ncpu,
-                                     verbose=False)
+        # stereoisomers are written to a temporary file, so an existing in_fname is complete
+        if not (resume and os.path.isfile(in_fname)):
+            gen_stereo_rdkit.main_params(in_fname=fname,
+                                         out_fname=in_fname + '.tmp',
+                                         tetrahedral=True,
+                                         double_bond=True,
+                                         max_undef=-1,
+                                         id_field_name=None,
+                                         ncpu=ncpu,
+                                         verbose=False)
+            os.replace(in_fname + '.tmp', in_fname)
 
     else:
         in_fname = fname
@@ -81,7 +86,8 @@ def gen_confs(fname, nconfs_list, stereo=True, path=None, ncpu=4):
                                ncpu=ncpu,
                                seed=42,
                                verbose=False,
-                               log=True)
+                               log=True,
+                               resume=resume)
 
     out_partfname = os.path.join(path, 'conf-{0}_{1}.pkl'.format(os.path.basename(in_fname).split('.')[0], '{}'))
     # take n-confromer from conformer-log file
@@ -110,6 +116,8 @@ if __name__ == '__main__':
                         help='Default - compute 3D coordinates only and use input stereo information')
     parser.add_argument('-nc', '--ncpu', metavar='cpu_number', default=1, type=int,
                         help='number of cpus to use for generating conformers')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue interrupted conformer generation')
     parser.add_argument('--ex_log', metavar='use exist Logfile', default=None,
                         help='Generate conformers from existed conformer file')
 
@@ -121,12 +129,14 @@ if __name__ == '__main__':
     stereo_ = args.stereo
     nconf_list_ = args.nconf
     ex_log_ = args.ex_log
+    resume_ = args.resume
 
     if ex_log_ is None:
         gen_confs(fname=in_fname_,
               nconfs_list=nconf_list_,
               stereo=stereo_,
               path=path_,
-              ncpu=ncpu_)
+              ncpu=ncpu_,
+              resume=resume_)
     else:
         out_fnames = get_from_exist_log(conf_log=ex_log_, nconfs_list=nconf_list_)
\ No newline at end of file
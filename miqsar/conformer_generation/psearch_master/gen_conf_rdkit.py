@@ -10,58 +10,83 @@ import os, time
 import sys
 import gzip
 import argparse
+import json
 import pickle
-from itertools import combinations
+import numpy as np
+from itertools import count, islice
 from rdkit import Chem
-from rdkit.Chem import AllChem
-from multiprocessing import Pool, cpu_count
+from rdkit.Chem import AllChem, rdMolDescriptors
+from multiprocessing import cpu_count
 
 # from .read_input import read_input
 if __name__ == '__main__':
     from read_input import read_input
+    from task_runner import run_tasks, report_stats
 else:
     from .read_input import read_input
+    from .task_runner import run_tasks, report_stats
 
 
-def prep_input(fname, id_field_name, nconf, energy, rms, seed):
+def prep_input(fname, id_field_name, nconf, skip=()):
+    # (mol, mol_name, act, mol_id, cost) of input molecules except those with names in skip
     input_format = 'smi' if fname is None else None
     for mol, mol_name, act, mol_id in read_input(fname, input_format=input_format, id_field_name=id_field_name):
-        yield mol, mol_name, nconf, energy, rms, seed, act, mol_id
+        if mol_name not in skip:
+            yield mol, mol_name, act, mol_id, estimate_cost(mol, nconf)
 
 
-def map_gen_conf(args):
-    return gen_confs(*args)
+def estimate_cost(mol, nconf):
+    # relative cost of conformer generation of a molecule
+    return (rdMolDescriptors.CalcNumRotatableBonds(mol) + 1) * nconf
 
 
-def sorted_confids(mol):
-    sorted_list = []
-
-    for conf in mol.GetConformers():
-        ff = AllChem.MMFFGetMoleculeForceField(mol, AllChem.MMFFGetMoleculeProperties(mol), confId=conf.GetId())
-        if ff is None:
-            pass
-            #print(Chem.MolToSmiles(mol))
-        else:
-            sorted_list.append((conf.GetId(), ff.CalcEnergy()))
-
-    if sorted_list:
-        sorted_list = sorted(sorted_list, key=lambda x: x[1])
-
-    return sorted_list
-
-
-def remove_confs(mol, energy, rms):
+def calc_energies(mol, props=None):
+    # [(confId, energy)] of all conformers, props are MMFF properties computed once for the molecule
+    if props is None:
+        props = AllChem.MMFFGetMoleculeProperties(mol)
+    if props is None:
+        return []
     e = []
     for conf in mol.GetConformers():
-        ff = AllChem.MMFFGetMoleculeForceField(mol, AllChem.MMFFGetMoleculeProperties(mol), confId=conf.GetId())
+        ff = AllChem.MMFFGetMoleculeForceField(mol, props, confId=conf.GetId())
         if ff is None:
-            #print(Chem.MolToSmiles(mol))
-            return
+            return []
         e.append((conf.GetId(), ff.CalcEnergy()))
-    e = sorted(e, key=lambda x: x[1])
+    return e
+
+
+def sorted_confids(mol, energies=None):
+    # energies: [(confId, energy)], if None they are calculated
+    if energies is None:
+        energies = calc_energies(mol)
+    return sorted(energies, key=lambda x: x[1])
+
+
+def get_rms(coords, ref_coords):
+    """
+    RMSD of the optimal superposition of every conformer onto the reference one, as GetConformerRMS calculates,
+    but conformers are not aligned (changed).
+    coords: (n_confs, n_atoms, 3), ref_coords: (n_atoms, 3), both centered.
+    """
+    h = np.einsum('ai,naj->nij', ref_coords, coords)
+    u, s, vh = np.linalg.svd(h)
+    # reflections are not allowed
+    s[:, 2] *= np.sign(np.linalg.det(u) * np.linalg.det(vh))
+    e = (ref_coords ** 2).sum() + (coords ** 2).sum(axis=(1, 2)) - 2 * s.sum(axis=1)
+    return np.sqrt(np.maximum(e, 0) / len(ref_coords))
+
+
+def remove_confs(mol, energy, rms, energies=None, heavy_atoms=False):
+    """
+    Conformers are taken in the order of increasing energy, a conformer is kept if its energy is not higher than
+    energy from the lowest one and its RMSD to all kept conformers is not lower than rms.
+    heavy_atoms: calculate RMSD over heavy atoms only.
+    Returns sorted by energy [(confId, energy)] of kept conformers.
+    """
+    e = sorted_confids(mol, energies)
 
     if not e:
-        return
+        return []
 
     kept_ids = [e[0][0]]
     remove_ids = []
@@ -72,114 +97,244 @@ def remove_confs(mol, energy, rms):
         else:
             remove_ids.append(item[0])
 
-    if rms is not None:
-        rms_list = [(i1, i2, AllChem.GetConformerRMS(mol, i1, i2)) for i1, i2 in combinations(kept_ids, 2)]
-        while any(item[2] < rms for item in rms_list):
-            for item in rms_list:
-                if item[2] < rms:
-                    i = item[1]
-                    remove_ids.append(i)
-                    break
-            rms_list = [item for item in rms_list if item[0] != i and item[1] != i]
-
-    for cid in set(remove_ids):
+    if rms is not None and len(kept_ids) > 1:
+        coords = np.array([mol.GetConformer(cid).GetPositions() for cid in kept_ids])
+        if heavy_atoms:
+            coords = coords[:, [a.GetIdx() for a in mol.GetAtoms() if a.GetAtomicNum() > 1]]
+        coords -= coords.mean(axis=1, keepdims=True)
+        accepted = [0]
+        for i in range(1, len(kept_ids)):
+            if (get_rms(coords[accepted], coords[i]) < rms).any():
+                remove_ids.append(kept_ids[i])
+            else:
+                accepted.append(i)
+
+    remove_ids = set(remove_ids)
+    for cid in remove_ids:
         mol.RemoveConformer(cid)
+    return [item for item in e if item[0] not in remove_ids]
 
 
-def gen_confs(mol, mol_name, nconf, energy, rms, seed, act, mol_id):
+def gen_confs(mol, mol_name, nconf, energy, rms, seed, act, mol_id, nthreads=1, heavy_atoms=False, embed_params=None):
+    """
+    nthreads: number of threads of embedding and MMFF optimization.
+    embed_params: dict of additional EmbedMultipleConfs arguments, e.g. {"ETversion": 1, "pruneRmsThresh": 0.3}.
+    Returns sorted by energy [(confId, energy)] of kept conformers along with the molecule.
+    """
     mol = Chem.AddHs(mol)
-    cids = AllChem.EmbedMultipleConfs(mol, numConfs=nconf, maxAttempts=700, randomSeed=seed)
+    params = dict(maxAttempts=700, randomSeed=seed, numThreads=nthreads)
+    params.update(embed_params or {})
+    AllChem.EmbedMultipleConfs(mol, numConfs=nconf, **params)
+
+    props = AllChem.MMFFGetMoleculeProperties(mol)
+    if props is None or mol.GetNumConformers() == 0:
+        # molecules which can't be typed by MMFF have no valid conformers
+        return mol_name, mol, act, mol_id, []
+    AllChem.MMFFOptimizeMoleculeConfs(mol, numThreads=nthreads)
+    # energies reported by the optimizer may differ in the last digits, they are recalculated with the same props
+    ids_sorted = remove_confs(mol, energy, rms, calc_energies(mol, props), heavy_atoms)
+    return mol_name, mol, act, mol_id, ids_sorted
+
+
+def write_confs(writer, output_file_type, mol_name, mol, act, mol_id, ids_sorted, log=False):
+    # writer is None for output to STDOUT in SDF format
+    if not ids_sorted:
+        pass
+        #print(Chem.MolToSmiles(mol), mol_name)
+
+    if output_file_type == 'pkl':
+        mol_conf_list = []
+
+        for confId, energ in ids_sorted:
+            name = '{name}_{confId}'.format(name=mol_name, confId=confId)
+            mol_conf = Chem.Mol(mol, False, confId)
+            if not log:
+                pickle.dump((mol_conf, name, act, mol_id), writer, -1)
+            else:
+                mol_conf_list.append((mol_conf, name, act, mol_id, energ))
 
-    for cid in cids:
-        AllChem.MMFFOptimizeMolecule(mol, confId=cid)
-    remove_confs(mol, energy, rms)
-    return mol_name, mol, act, mol_id
+        if log and mol_conf_list:
+            pickle.dump(mol_conf_list, writer, -1)
 
+    else:
+        mol.SetProp("_Name", mol_name)
+        mol.SetProp("Act", str(act))
+        mol.SetProp("Mol", mol_id)
 
-def main_params(in_fname, out_fname, id_field_name, nconf, energy, rms, ncpu, seed, verbose, log=False):
+        if output_file_type == 'sdf':
+            for confId, energ in ids_sorted:
+                name = '{name}_{confId}'.format(name=mol_name, confId=confId)
+                mol.SetProp("_Name", name)
+                writer.write(mol, confId=confId)
+        else:
+            string = "$$$$\n".join(Chem.MolToMolBlock(mol, confId=c.GetId()) for c in mol.GetConformers())
+            if string:  # wrong molecules (no valid conformers) will result in empty string
+                string += "$$$$\n"
+                if writer is None:
+                    sys.stdout.write(string)
+                    #sys.stdout.flush()
+                else:
+                    writer.write(string.encode("ascii") if output_file_type == 'sdf.gz' else string)
+
+
+def report_timing(timing, fname=None, verbose=True, top=10):
+    # timing: [(mol_name, mol_id, cost, nthreads, seconds)]
+    timing = sorted(timing, key=lambda x: x[-1], reverse=True)
+    if fname is not None:
+        with open(fname, 'wt') as f:
+            f.write('mol_name\tmol_id\tcost\tnthreads\ttime\n')
+            for mol_name, mol_id, cost, nthreads, sec in timing:
+                f.write('%s\t%s\t%i\t%i\t%.3f\n' % (mol_name, mol_id, cost, nthreads, sec))
+    if verbose and timing:
+        sys.stderr.write('the slowest molecules (cost, threads): %s\n' %
+                         ', '.join('%s (%i, %i) %.2fs' % (mol_name, cost, nthreads, sec)
+                                   for mol_name, mol_id, cost, nthreads, sec in timing[:top]))
+
+
+def read_index(fname):
+    # [mol_name, mol_id, number of conformers, end offset of the record in the output] of completely written molecules
+    records = []
+    if os.path.isfile(fname):
+        with open(fname) as f:
+            for line in f:
+                items = line.rstrip('\n').split('\t')
+                # the last line may be incomplete if the run was interrupted
+                if line.endswith('\n') and len(items) == 4:
+                    records.append(items)
+    return records
+
+
+def main_params(in_fname, out_fname, id_field_name, nconf, energy, rms, ncpu, seed, verbose, log=False, nthreads=1,
+                heavy_atoms=False, embed_params=None, thread_cost=None, timing_fname=None, timeout=None,
+                reject_fname=None, resume=False, window=10000):
+    """
+    The input is read lazily by windows of window molecules. Molecules of a window are processed in the order of
+    decreasing estimated cost (number of rotatable bonds + 1) * nconf, molecules with cost not lower than thread_cost
+    are processed one by one before others using ncpu threads, others are processed by ncpu processes using nthreads
+    threads each.
+    timing_fname: text file to store time of every molecule, the slowest ones are printed if verbose.
+    timeout: molecules processed longer than timeout seconds are discarded, their workers are killed.
+    reject_fname: smi file of failed molecules (smiles,mol_name,act,mol_id,reason).
+    resume: SDF and PKL output is accompanied by out_fname.idx file of written molecules, if True molecules
+            of the index are skipped and new ones are appended to the output of the interrupted run.
+            Failed molecules are not indexed and are processed again, so the reject file is rewritten.
+    """
     start_time = time.time()
 
     output_file_type = None
+    writer = None
+    out_file = None
+    index = None
+    done = set()
     if out_fname is not None:
 
-        if os.path.isfile(out_fname):
-            os.remove(out_fname)
+        index_fname = out_fname + '.idx'
+        if resume:
+            if out_fname.lower().endswith('.sdf.gz'):
+                raise Exception("Resume is possible only for SDF or PKL output.")
+            # molecules written after the last indexed one are discarded
+            records = read_index(index_fname)
+            done = set(r[0] for r in records)
+            if os.path.isfile(out_fname):
+                with open(out_fname, 'r+b') as f:
+                    f.truncate(int(records[-1][3]) if records else 0)
+            with open(index_fname, 'wt') as f:
+                f.writelines('\t'.join(r) + '\n' for r in records)
+        else:
+            for fname in (out_fname, index_fname):
+                if os.path.isfile(fname):
+                    os.remove(fname)
 
         if out_fname.lower().endswith('.sdf.gz'):
             writer = gzip.open(out_fname, 'a')
             output_file_type = 'sdf.gz'
         elif out_fname.lower().endswith('.sdf'):
-            # writer = open(out_fname, 'at')
-            writer = Chem.SDWriter(out_fname)
+            out_file = open(out_fname, 'at')
+            writer = Chem.SDWriter(out_file)
             output_file_type = 'sdf'
         elif out_fname.lower().endswith('.pkl'):
-            writer = open(out_fname, 'wb')
+            out_file = writer = open(out_fname, 'ab')
             output_file_type = 'pkl'
         else:
             raise Exception("Wrong output file format. Can be only SDF, SDF.GZ or PKL.")
 
-    nprocess = min(cpu_count(), max(ncpu, 1))
-    p = Pool(nprocess)
-
-    try:
-        for i, (mol_name, mol, act, mol_id) in enumerate(
-                p.imap_unordered(map_gen_conf, prep_input(in_fname, id_field_name, nconf, energy, rms, seed),
-                                 chunksize=10), 1):
-
-            # get sorted by energy list of conformerIDs [(confIds, energy)]
-            ids_sorted = sorted_confids(mol)
+        if out_file is not None:
+            index = open(index_fname, 'at')
 
-            if not ids_sorted:
-                pass
-                #print(Chem.MolToSmiles(mol), mol_name)
-
-            if output_file_type == 'pkl':
-                mol_conf_list = []
-
-                for confId, energ in ids_sorted:
-                    name = '{name}_{confId}'.format(name=mol_name, confId=confId)
-                    mol_conf = Chem.Mol(mol, False, confId)
-                    if not log:
-                        pickle.dump((mol_conf, name, act, mol_id), writer, -1)
-                    else:
-                        mol_conf_list.append((mol_conf, name, act, mol_id, energ))
+    nprocess = min(cpu_count(), max(ncpu, 1))
 
-                if log and mol_conf_list:
-                    pickle.dump(mol_conf_list, writer, -1)
+    if verbose and done:
+        sys.stderr.write('%i molecules were processed before and are skipped\n' % len(done))
+
+    tasks = dict()  # task_id: (mol, mol_name, act, mol_id, cost) of submitted molecules
+    task_ids = count()
+
+    def get_tasks(mols, params):
+        for mol, mol_name, act, mol_id, cost in mols:
+            task_id = next(task_ids)
+            tasks[task_id] = mol, mol_name, act, mol_id, cost
+            yield task_id, dict(mol=mol, mol_name=mol_name, act=act, mol_id=mol_id, **params)
+
+    def run():
+        mols = prep_input(in_fname, id_field_name, nconf, done)
+        for chunk in iter(lambda: list(islice(mols, max(window, 1))), []):
+            # expensive molecules first to avoid a long tail at the end of the window
+            chunk.sort(key=lambda m: m[4], reverse=True)
+            heavy = [m for m in chunk if thread_cost is not None and m[4] >= thread_cost]
+            light = chunk[len(heavy):]
+            for group, nproc, threads in ((heavy, 1, nprocess), (light, nprocess, nthreads)):
+                params = dict(nconf=nconf, energy=energy, rms=rms, seed=seed, nthreads=threads,
+                              heavy_atoms=heavy_atoms, embed_params=embed_params)
+                for res in run_tasks(gen_confs, get_tasks(group, params), nproc, timeout):
+                    yield res + (threads, )
+
+    timing, seconds, n_failed = [], [], 0
+    rejects = open(reject_fname, 'wt') if reject_fname is not None else None
 
-            else:
-                mol.SetProp("_Name", mol_name)
-                mol.SetProp("Act", str(act))
-                mol.SetProp("Mol", mol_id)
-
-                if output_file_type == 'sdf':
-                    for confId, energ in ids_sorted:
-                        name = '{name}_{confId}'.format(name=mol_name, confId=confId)
-                        mol.SetProp("_Name", name)
-                        writer.write(mol, confId=confId)
-                else:
-                    string = "$$$$\n".join(Chem.MolToMolBlock(mol, confId=c.GetId()) for c in mol.GetConformers())
-                    if string:  # wrong molecules (no valid conformers) will result in empty string
-                        string += "$$$$\n"
-                        if out_fname is None:
-                            sys.stdout.write(string)
-                            #sys.stdout.flush()
-                        else:
-                            writer.write(string.encode("ascii") if output_file_type == 'sdf.gz' else string)
+    try:
+        # workers return sorted by energy list of conformerIDs [(confIds, energy)]
+        for i, (task_id, res, err, sec, threads) in enumerate(run(), 1):
+            seconds.append(sec)
+            mol, mol_name, act, mol_id, cost = tasks.pop(task_id)
+            if err is not None:
+                n_failed += 1
+                if verbose:
+                    sys.stderr.write('\n%s failed after %is: %s\n' % (mol_name, sec, err))
+                if rejects is not None:
+                    rejects.write('%s,%s,%s,%s,%s\n' % (Chem.MolToSmiles(mol, isomericSmiles=True), mol_name, act,
+                                                        mol_id, ' '.join(err.replace(',', ';').split())))
+                    rejects.flush()
+                continue
+
+            mol_name, mol, act, mol_id, ids_sorted = res
+            write_confs(writer, output_file_type, mol_name, mol, act, mol_id, ids_sorted, log)
+            if index is not None:
+                # a molecule is indexed only after its conformers were written
+                writer.flush()
+                out_file.flush()
+                index.write('%s\t%s\t%i\t%i\n' % (mol_name, mol_id, len(ids_sorted), out_file.tell()))
+                index.flush()
+            timing.append((mol_name, mol_id, cost, threads, sec))
 
             if verbose and i % 10 == 0:
                 sys.stderr.write('\r%i molecules passed/conformers (%is)' % (i, time.time() - start_time))
                 sys.stderr.flush()
 
     finally:
-        p.close()
-        p.join()
+        if rejects is not None:
+            rejects.close()
+        if index is not None:
+            index.close()
 
     if out_fname is not None:
         writer.close()
+    if out_file is not None:
+        out_file.close()
 
     if verbose:
         sys.stderr.write("\n")
+        report_stats(seconds, n_failed, time.time() - start_time)
+    report_timing(timing, timing_fname, verbose)
 
 
 if __name__ == '__main__':
@@ -203,10 +358,35 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--rms', metavar='rms_threshold', default=.5,
                         help='only conformers with RMS higher then threshold will be kept. '
                              'Default: None (keep all conformers).')
+    parser.add_argument('--heavy_rms', action='store_true', default=False,
+                        help='calculate RMS between conformers over heavy atoms only.')
     parser.add_argument('-s', '--seed', metavar='random_seed', default=-1,
                         help='integer to init random number generator. Default: -1 (means no seed).')
     parser.add_argument('-c', '--ncpu', metavar='cpu_number', default=1,
                         help='number of cpu to use for calculation. Default: 1.')
+    parser.add_argument('-t', '--nthreads', metavar='thread_number', default=1,
+                        help='number of threads of embedding and MMFF optimization of conformers of a molecule '
+                             'in every process. Default: 1.')
+    parser.add_argument('--thread_cost', metavar='cost', default=None,
+                        help='molecules with estimated cost (number of rotatable bonds + 1) * nconf not lower than '
+                             'the specified value are processed one by one using ncpu threads. '
+                             'Default: None (all molecules are processed by ncpu processes).')
+    parser.add_argument('--embed_params', metavar='json', default=None,
+                        help='additional EmbedMultipleConfs arguments as json, '
+                             'e.g. \'{"ETversion": 1, "pruneRmsThresh": 0.3}\'.')
+    parser.add_argument('--window', metavar='mol_number', default=10000,
+                        help='number of molecules read from the input and ordered by estimated cost at a time. '
+                             'Default: 10000.')
+    parser.add_argument('--timing', metavar='timing.txt', default=None,
+                        help='text file to store time of conformer generation of every molecule.')
+    parser.add_argument('--timeout', metavar='seconds', default=None,
+                        help='maximum time of conformer generation of a molecule, molecules processed longer are '
+                             'discarded. Default: None (no limit).')
+    parser.add_argument('--reject', metavar='reject.smi', default=None,
+                        help='file to store failed and timed out molecules along with the reason.')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue an interrupted run: molecules listed in the index file (output.idx) are '
+                             'skipped, conformers of other ones are appended to the output. SDF and PKL only.')
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help='print progress to STDERR.')
 
@@ -217,10 +397,19 @@ if __name__ == '__main__':
         if o == "id_field_name": id_field_name = v
         if o == "nconf": nconf = int(v)
         if o == "ncpu": ncpu = int(v)
+        if o == "nthreads": nthreads = int(v)
         if o == "energy_cutoff": energy = float(v)
         if o == "seed": seed = int(v)
         if o == "rms": rms = float(v) if v is not None else None
         if o == "verbose": verbose = v
+        if o == "heavy_rms": heavy_atoms = v
+        if o == "thread_cost": thread_cost = int(v) if v is not None else None
+        if o == "embed_params": embed_params = json.loads(v) if v is not None else None
+        if o == "timing": timing_fname = v
+        if o == "timeout": timeout = float(v) if v is not None else None
+        if o == "reject": reject_fname = v
+        if o == "resume": resume = v
+        if o == "window": window = int(v)
 
     main_params(in_fname=in_fname,
                 out_fname=out_fname,
@@ -230,4 +419,13 @@ if __name__ == '__main__':
                 rms=rms,
                 ncpu=ncpu,
                 seed=seed,
-                verbose=verbose)
+                verbose=verbose,
+                nthreads=nthreads,
+                heavy_atoms=heavy_atoms,
+                embed_params=embed_params,
+                thread_cost=thread_cost,
+                timing_fname=timing_fname,
+                timeout=timeout,
+                reject_fname=reject_fname,
+                resume=resume,
+                window=window)
@@ -12,11 +12,13 @@ from rdkit import Chem
 from rdkit.Chem import AllChem
 from itertools import product
 from copy import deepcopy
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 if __name__ == '__main__':
     from read_input import read_input
+    from task_runner import run_tasks, report_stats
 else:
     from .read_input import read_input
+    from .task_runner import run_tasks, report_stats
 
 
 def prep_input(fname, id_field_name, tetrahedral, double_bond, max_undef):
@@ -24,10 +26,6 @@ def prep_input(fname, id_field_name, tetrahedral, double_bond, max_undef):
         yield mol, mol_name, tetrahedral, double_bond, max_undef, act
 
 
-def map_enumerate_stereo(args):
-    return enumerate_stereo(*args)
-
-
 def get_unspec_double_bonds(m):
 
     def check_nei_bonds(bond):
@@ -169,7 +167,12 @@ def enumerate_stereo(mol, mol_name, tetrahedral, double_bond, max_undef, act):
     return [(smi, "%s_%i" % (mol_name, i+1), act, mol_name) for i, smi in enumerate(output)]
 
 
-def main_params(in_fname, out_fname, tetrahedral, double_bond, max_undef, id_field_name, ncpu, verbose):
+def main_params(in_fname, out_fname, tetrahedral, double_bond, max_undef, id_field_name, ncpu, verbose, timeout=None,
+                reject_fname=None):
+    """
+    timeout: molecules processed longer than timeout seconds are discarded, their workers are killed.
+    reject_fname: smi file of failed molecules (smiles,mol_name,act,mol_id,reason).
+    """
     
     start_time = time.time()
 
@@ -177,13 +180,30 @@ def main_params(in_fname, out_fname, tetrahedral, double_bond, max_undef, id_fie
         fout = open(out_fname, 'wt')
 
     nprocess = min(cpu_count(), max(ncpu, 1))
-    p = Pool(nprocess)
+    tasks = dict()
+    seconds, n_failed = [], 0
+    rejects = open(reject_fname, 'wt') if reject_fname is not None else None
+
+    def get_tasks():
+        for task_id, task in enumerate(prep_input(in_fname, id_field_name, tetrahedral, double_bond, max_undef)):
+            tasks[task_id] = task
+            yield task_id, task
 
     try:
-        for i, res in enumerate(p.imap_unordered(map_enumerate_stereo,
-                                                 prep_input(in_fname, id_field_name, tetrahedral, double_bond, max_undef),
-                                                 chunksize=10
-                                      )):
+        for i, (task_id, res, err, sec) in enumerate(run_tasks(enumerate_stereo, get_tasks(), nprocess, timeout)):
+            seconds.append(sec)
+            task = tasks.pop(task_id)
+            mol, mol_name, act = task[0], task[1], task[5]
+            if err is not None:
+                n_failed += 1
+                if verbose:
+                    sys.stderr.write('\n%s failed after %is: %s\n' % (mol_name, sec, err))
+                if rejects is not None:
+                    rejects.write('%s,%s,%s,%s,%s\n' % (Chem.MolToSmiles(mol, isomericSmiles=True), mol_name, act,
+                                                        mol_name, ' '.join(err.replace(',', ';').split())))
+                    rejects.flush()
+                continue
+
             if out_fname is None:
                 for smi, mol_name in res:
                     print(smi + '\t' + mol_name)
@@ -195,14 +215,15 @@ def main_params(in_fname, out_fname, tetrahedral, double_bond, max_undef, id_fie
                 sys.stderr.write('\r%i molecules were processed/stereo (%is)' % (i, time.time() - start_time))
                 sys.stderr.flush()
     finally:
-        p.close()
-        p.join()
+        if rejects is not None:
+            rejects.close()
 
     if out_fname is not None:
         fout.close()
         
     if verbose:
         sys.stderr.write("\n")
+        report_stats(seconds, n_failed, time.time() - start_time)
         
 
 def main():
@@ -227,6 +248,11 @@ def main():
                              'If omitted molecule titles will be used or SMILES string as name.')
     parser.add_argument('-c', '--ncpu', metavar='cpu_number', default=1,
                         help='number of cpus to use for calculation. Default: 1.')
+    parser.add_argument('--timeout', metavar='seconds', default=None,
+                        help='maximum time of enumeration of stereoisomers of a molecule, molecules processed longer '
+                             'are discarded. Default: None (no limit).')
+    parser.add_argument('--reject', metavar='reject.smi', default=None,
+                        help='file to store failed and timed out molecules along with the reason.')
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help='print progress to STDERR.')
 
@@ -240,12 +266,15 @@ def main():
         if o == "tetrahedral": tetrahedral = v
         if o == "double_bond": double_bond = v
         if o == "verbose": verbose = v
+        if o == "timeout": timeout = float(v) if v is not None else None
+        if o == "reject": reject_fname = v
 
     if not tetrahedral and not double_bond:
         print("You should specify at least one option -t or -d. Revise you command line arguments.")
         exit()
 
-    main_params(in_fname, out_fname, tetrahedral, double_bond, max_undef, id_field_name, ncpu, verbose)
+    main_params(in_fname, out_fname, tetrahedral, double_bond, max_undef, id_field_name, ncpu, verbose, timeout,
+                reject_fname)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import numpy as np
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+
+
+def _worker(func, conn):
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        task_id, args = task
+        start = time.time()
+        try:
+            res, err = (func(**args) if isinstance(args, dict) else func(*args)), None
+        except Exception as e:
+            res, err = None, '%s: %s' % (type(e).__name__, e)
+        conn.send((task_id, res, err, time.time() - start))
+
+
+def run_tasks(func, tasks, ncpu=1, timeout=None):
+    """
+    Calls func(*args) for every (task_id, args) of tasks in ncpu worker processes, func(**args) if args is a dict.
+    A task running longer than timeout seconds is killed along with its worker, a worker which died (e.g. crashed
+    in C++ code) is restarted, the rest of tasks keep running.
+    Yields (task_id, result, error, seconds) in the order of completion, error is None or the reason of failure:
+    'timeout', 'worker died' or the raised exception.
+    """
+    tasks = iter(tasks)
+    workers = dict()  # connection: [process, task_id, start time]
+
+    def start_worker():
+        conn, child_conn = Pipe()
+        p = Process(target=_worker, args=(func, child_conn), daemon=True)
+        p.start()
+        child_conn.close()
+        workers[conn] = [p, None, None]
+        return conn
+
+    def stop_worker(conn, kill=False):
+        p = workers.pop(conn)[0]
+        if kill:
+            p.kill()
+        else:
+            conn.send(None)
+        p.join()
+        conn.close()
+
+    def submit(conn):
+        # returns False if there are no more tasks
+        for task_id, args in tasks:
+            conn.send((task_id, args))
+            workers[conn][1:] = [task_id, time.time()]
+            return True
+        stop_worker(conn)
+        return False
+
+    try:
+        for _ in range(max(ncpu, 1)):
+            if not submit(start_worker()):
+                break
+
+        while workers:
+            if timeout is None:
+                ready = wait(list(workers))
+            else:
+                deadline = min(w[2] for w in workers.values()) + timeout
+                ready = wait(list(workers), max(deadline - time.time(), 0))
+
+            for conn in ready:
+                try:
+                    yield conn.recv()
+                except (EOFError, OSError):
+                    task_id, start = workers[conn][1:]
+                    stop_worker(conn, kill=True)
+                    yield task_id, None, 'worker died', time.time() - start
+                    conn = start_worker()
+                submit(conn)
+
+            if timeout is not None:
+                now = time.time()
+                for conn in [c for c, w in workers.items() if now - w[2] > timeout and c not in ready]:
+                    task_id, start = workers[conn][1:]
+                    stop_worker(conn, kill=True)
+                    yield task_id, None, 'timeout', now - start
+                    submit(start_worker())
+
+    finally:
+        for conn in list(workers):
+            stop_worker(conn, kill=True)
+
+
+def report_stats(seconds, n_failed, elapsed, name='molecules'):
+    # throughput and tail latency, seconds: time of every task including failed ones
+    sys.stderr.write('%i %s processed, %i failed, %.1fs, %.2f %s/s\n' %
+                     (len(seconds), name, n_failed, elapsed, len(seconds) / max(elapsed, 1e-9), name))
+    if len(seconds):
+        sec = np.asarray(seconds)
+        sys.stderr.write('time per task: median %.2fs, 95%% %.2fs, 99%% %.2fs, max %.2fs\n' %
+                         (np.median(sec), np.percentile(sec, 95), np.percentile(sec, 99), sec.max()))
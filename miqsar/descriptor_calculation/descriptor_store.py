@@ -0,0 +1,197 @@
+import os
+import json
+import struct
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# A descriptor store is a data file plus a <name>.json sidecar with the column names and
+# the mol_id/mol_title/act of every row:
+#   <name>.npy - dense matrix, read with np.load(mmap_mode='r')
+#   <name>.npz - scipy CSR matrix for sparse fingerprints
+#   <name>.npy - np.packbits(axis=1) matrix for binary fingerprints (format 'bits')
+# The dtype of the matrix is kept (uint8 for fingerprints, uint16 for counts, float32 for descriptors).
+
+META_COLS = ['mol_id', 'mol_title', 'act']
+
+
+def store_name(fname):
+    name, ext = os.path.splitext(fname)
+    return name if ext in ('.csv', '.npy', '.npz', '.json') else fname
+
+
+def store_exists(fname):
+    return os.path.exists(store_name(fname) + '.json')
+
+
+def _meta_list(values):
+    return [None if pd.isna(i) else str(i) for i in values]
+
+
+def _act_list(values):
+    act = []
+    for i in values:
+        try:
+            i = float(i)
+        except (TypeError, ValueError):
+            i = float('nan')
+        act.append(None if np.isnan(i) else i)
+    return act
+
+
+def _write_meta(name, columns, mol_id, mol_title, act, shape, dtype, fmt):
+    meta = {'format': fmt, 'shape': list(shape), 'dtype': np.dtype(dtype).str,
+            'columns': [str(i) for i in columns],
+            'mol_id': _meta_list(mol_id), 'mol_title': _meta_list(mol_title), 'act': _act_list(act)}
+    with open(name + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def read_meta(fname):
+    with open(store_name(fname) + '.json') as f:
+        return json.load(f)
+
+
+def write_store(fname, x, columns, mol_id, mol_title, act, packed=False):
+    # packed=True: x is a np.packbits(axis=1) matrix of len(columns) bits per row
+    name = store_name(fname)
+    if packed:
+        out = name + '.npy'
+        np.save(out, np.ascontiguousarray(x, dtype=np.uint8))
+        _write_meta(name, columns, mol_id, mol_title, act, (len(x), len(columns)), 'uint8', 'bits')
+        return out
+    if sparse.issparse(x):
+        x = sparse.csr_matrix(x)
+        out = name + '.npz'
+        sparse.save_npz(out, x, compressed=False)
+        fmt = 'csr'
+    else:
+        x = np.ascontiguousarray(x)
+        out = name + '.npy'
+        np.save(out, x)
+        fmt = 'dense'
+    _write_meta(name, columns, mol_id, mol_title, act, x.shape, x.dtype, fmt)
+    return out
+
+
+def write_frame(fname, data, dtype='float32', out_format='csv', index=True):
+    """
+    Writes a descriptor frame with mol_id/mol_title/act columns (mol_title may be the index)
+    either as CSV or as a store (out_format='npy').
+    """
+    if out_format == 'csv':
+        out = store_name(fname) + '.csv'
+        data.to_csv(out, index=index)
+        return out
+
+    if 'mol_title' not in data.columns:
+        data = data.reset_index()
+    if 'act' not in data.columns:
+        data = data.assign(act=None)
+    dsc = data.drop(META_COLS, axis=1)
+    return write_store(fname, dsc.to_numpy(dtype=dtype), dsc.columns, data['mol_id'], data['mol_title'], data['act'])
+
+
+def read_store(fname, columns=None, mmap_mode='r'):
+    """
+    Returns the descriptor matrix and the sidecar dict. Dense stores are memory-mapped,
+    columns selects a subset of descriptor columns by name.
+    """
+    name = store_name(fname)
+    meta = read_meta(name)
+    if meta['format'] == 'csr':
+        x = sparse.load_npz(name + '.npz').tocsr()
+    elif meta['format'] == 'bits':
+        x = np.unpackbits(np.load(name + '.npy', mmap_mode=mmap_mode), axis=1, count=meta['shape'][1])
+    else:
+        x = np.load(name + '.npy', mmap_mode=mmap_mode)
+
+    if columns is not None:
+        col_idx = {c: i for i, c in enumerate(meta['columns'])}
+        idx = [col_idx[str(c)] for c in columns]
+        x = x[:, idx]
+        meta['columns'] = [meta['columns'][i] for i in idx]
+    return x, meta
+
+
+def read_frame(fname, columns=None):
+    x, meta = read_store(fname, columns=columns)
+    if sparse.issparse(x):
+        x = x.toarray()
+    data = pd.DataFrame(np.array(x), columns=meta['columns'])
+    for col in META_COLS:
+        data[col] = meta[col]
+    data['act'] = data['act'].astype(float)
+    return data
+
+
+def read_descriptors(fname, columns=None):
+    """
+    Reads a store if there is one for fname, the CSV otherwise, in the CSV layout.
+    """
+    if store_exists(fname):
+        return read_frame(fname, columns=columns)
+    usecols = None if columns is None else META_COLS + [str(c) for c in columns]
+    data = pd.read_csv(store_name(fname) + '.csv', usecols=usecols)
+    return data
+
+
+def _npy_header(shape, dtype, size=128):
+    # fixed size header, so the row count can be rewritten once all chunks are written
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                                       tuple(shape))
+    header = header.ljust(size - 11) + '\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class StoreWriter:
+    """
+    Appends row chunks to a dense store without holding the whole matrix in memory.
+    Columns that got NaN in any row are dropped on close when drop_nan=True.
+    """
+
+    def __init__(self, fname, columns, dtype='float32'):
+        self.name = store_name(fname)
+        self.columns = [str(i) for i in columns]
+        self.dtype = np.dtype(dtype)
+        self.n_rows = 0
+        self.mol_id, self.mol_title, self.act = [], [], []
+        self.nan_cols = np.zeros(len(self.columns), dtype=bool)
+        self.f = open(self.name + '.npy', 'wb')
+        self.f.write(_npy_header((0, len(self.columns)), self.dtype))
+
+    def append(self, x, mol_id, mol_title, act):
+        x = np.asarray(x, dtype=self.dtype).reshape(-1, len(self.columns))
+        if self.dtype.kind == 'f':
+            self.nan_cols |= np.isnan(x).any(axis=0)
+        self.f.write(np.ascontiguousarray(x).tobytes())
+        self.n_rows += len(x)
+        self.mol_id.extend(mol_id)
+        self.mol_title.extend(mol_title)
+        self.act.extend(act)
+
+    def close(self, drop_nan=False, chunk_size=4096):
+        self.f.seek(0)
+        self.f.write(_npy_header((self.n_rows, len(self.columns)), self.dtype))
+        self.f.close()
+
+        columns = self.columns
+        if drop_nan and self.n_rows and self.nan_cols.any():
+            keep = np.flatnonzero(~self.nan_cols)
+            x = np.load(self.name + '.npy', mmap_mode='r')
+            tmp = self.name + '.tmp.npy'
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=self.dtype, shape=(self.n_rows, len(keep)))
+            for i in range(0, self.n_rows, chunk_size):
+                out[i:i + chunk_size] = x[i:i + chunk_size][:, keep]
+            out.flush()
+            del x, out
+            os.replace(tmp, self.name + '.npy')
+            columns = [columns[i] for i in keep]
+
+        _write_meta(self.name, columns, self.mol_id, self.mol_title, self.act,
+                    (self.n_rows, len(columns)), self.dtype, 'dense')
+        return self.name + '.npy'
+
+    @property
+    def nan_columns(self):
+        return [c for c, i in zip(self.columns, self.nan_cols) if i]
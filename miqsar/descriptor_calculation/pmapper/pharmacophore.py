@@ -14,8 +14,8 @@ from rdkit import Chem
 from rdkit.Chem import Conformer, rdMolAlign
 from rdkit.Geometry import Point3D
 from collections import Counter, defaultdict, OrderedDict
-from itertools import combinations, product, permutations
-from hashlib import md5
+from itertools import combinations, product, permutations, chain
+from hashlib import md5, blake2b
 from xml.dom import minidom
 from networkx.algorithms import isomorphism as iso
 from math import sqrt, asin, pi
@@ -37,11 +37,14 @@ def read_smarts_feature_file(file_name):
     return output
 
 
-def load_multi_conf_mol(mol, smarts_features=None, factory=None, bin_step=1, cached=False):
+def load_multi_conf_mol(mol, smarts_features=None, factory=None, bin_step=1, cached=False, signature_cache=None):
     # factory or smarts_featurs should be None to select only one procedure
+    # conformers share signature_cache, a new one is made if it is None
     if smarts_features is not None and factory is not None:
         raise Exception("Only one options should be not None (smarts_features or factory)")
     output = []
+    if signature_cache is None:
+        signature_cache = SignatureCache()
     p = Pharmacophore(bin_step, cached)
     if smarts_features is not None:
         ids = p._get_features_atom_ids(mol, smarts_features)
@@ -50,24 +53,117 @@ def load_multi_conf_mol(mol, smarts_features=None, factory=None, bin_step=1, cac
     else:
         return output
     for conf in mol.GetConformers():
-        p = Pharmacophore(bin_step, cached)
+        p = Pharmacophore(bin_step, cached, signature_cache)
         p.load_from_atom_ids(mol, ids, conf.GetId())
         output.append(p)
     return output
 
 
+def get_multi_conf_fp(mol, smarts_features=None, factory=None, bin_step=1, min_features=3, max_features=3, tol=0,
+                      nbits=2048, activate_bits=1, legacy=True):
+    # fingerprints of all conformers of mol as (n_conformers, nbits) uint8 array, see get_fp
+    ps = load_multi_conf_mol(mol, smarts_features=smarts_features, factory=factory, bin_step=bin_step)
+    fp = np.zeros((len(ps), nbits), dtype=np.uint8)
+    for i, p in enumerate(ps):
+        fp[i, list(p.get_fp(min_features, max_features, tol, nbits, activate_bits, legacy))] = 1
+    return fp
+
+
+def _int_hash(s):
+    # stable (unlike hash()) 64-bit hash of a string
+    return int.from_bytes(blake2b(s.encode(), digest_size=8).digest(), 'little')
+
+
+def _hash_bits(hashes, nbits, activate_bits=1):
+    # (n, activate_bits) array of bits for every hash taken from the splitmix64 sequence started at the hash
+    x = np.asarray(hashes, dtype=np.uint64)
+    bits = np.empty((len(x), activate_bits), dtype=np.int64)
+    for i in range(activate_bits):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        z = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+        bits[:, i] = z % np.uint64(nbits)
+    return bits
+
+
+class SignatureCache():
+    """
+    Canonical names of quadruplets shared by pharmacophores of conformers of one molecule.
+    A name and the order of features used to get stereo depend only on feature labels and binned
+    distances, so they are computed once for every combination of them met in any conformer.
+    hits and misses count lookups of distinct quadruplets of a pharmacophore.
+    """
+
+    __slots__ = ('quadruplets', 'names', 'name_ids', 'signatures', 'hashes', 'hits', 'misses')
+
+    def __init__(self):
+        self.quadruplets = dict()  # packed labels and distances: (name id, 4 feature positions, kind)
+        self.names = []
+        self.name_ids = dict()
+        self.signatures = dict()  # (name id * 32 + stereo + 16, tol): signature string
+        self.hashes = dict()  # (name id * 32 + stereo + 16, tol): fingerprint hash of a single signature
+        self.hits = 0
+        self.misses = 0
+
+    def get_name_ids(self, names):
+        name_ids = self.name_ids
+        res = [name_ids.setdefault(name, len(name_ids)) for name in names]
+        n = len(self.names)
+        self.names.extend(name for name, i in zip(names, res) if i >= n)
+        return res
+
+    def get_signature(self, key, tol):
+        # signature string of a code made by PharmacophoreBase.__get_signature_keys_batch
+        try:
+            return self.signatures[(key, tol)]
+        except KeyError:
+            res = str((self.names[key >> 5], (key & 31) - 16, tol))
+            self.signatures[(key, tol)] = res
+            return res
+
+    def get_hash(self, key, tol):
+        # the same as _int_hash of a feature combination with the only signature, see PharmacophoreBase.get_fp
+        try:
+            return self.hashes[(key, tol)]
+        except KeyError:
+            res = _int_hash(str(((self.get_signature(key, tol), 1),)))
+            self.hashes[(key, tol)] = res
+            return res
+
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+
 class PharmacophoreBase():
 
     __primes_vertex = {'a': 2, 'H': 3, 'A': 5, 'D': 7, 'P': 11,'N': 13}
     __primes_edge = (31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137,
                      139, 149, 151, 157, 163, 167, 173, 179, 181, 191, 193, 197, 199, 211, 223, 227, 229)
-
-    def __init__(self, bin_step=1, cached=False):
-        self.__g = nx.Graph()
+    __label_codes = {label: i for i, label in enumerate(sorted(__primes_vertex))}
+    # signatures of pharmacophores with at least that many features are computed by the batch engine
+    __min_batch_features = 6
+    __combination_index = dict()
+
+    # features are kept as labels (and their integer codes), coordinates and a matrix of binned distances,
+    # the networkx graph is only built when it is requested (get_graph, fit_model)
+    __slots__ = ('__labels', '__codes', '__xyz', '__coords', '__dists', '__dist_list', '__tokens', '__g',
+                 '__bin_step', '__cached', '__cache', '__signature_cache')
+
+    def __init__(self, bin_step=1, cached=False, signature_cache=None):
+        self.__labels = ()
+        self.__codes = np.zeros(0, dtype=np.int8)
+        self.__xyz = ()
+        self.__coords = np.zeros((0, 3))
+        self.__dists = np.zeros((0, 0), dtype=int)
+        self.__dist_list = []
+        self.__tokens = None
+        self.__g = None
         self.__bin_step = bin_step
         self.__cached = cached
         self.__cache = dict()
-        self.__nx_version = int(nx.__version__.split('.')[0])
+        self.__signature_cache = signature_cache
 
     @staticmethod
     def __remove_dupl(ls):
@@ -80,31 +176,57 @@ class PharmacophoreBase():
         # feature_coords: [('A', (1.23, 2.34, 3.45)), ('A', (4.56, 5.67, 6.78)), ...]
         # remove full duplicates from features
         feature_coords = self.__remove_dupl(feature_coords)
-        self.__g.clear()
-        for i, (label, coords) in enumerate(feature_coords):
-            self.__g.add_node(i, label=label, xyz=coords, plabel=PharmacophoreBase.__primes_vertex[label])
+        self.__labels = tuple(label for label, coords in feature_coords)
+        self.__codes = np.array([PharmacophoreBase.__label_codes[label] for label in self.__labels], dtype=np.int8)
+        self.__xyz = tuple(coords for label, coords in feature_coords)
+        self.__coords = np.array(self.__xyz, dtype=float).reshape(-1, 3)
         self.__update_dists()
 
     def __update_dists(self, bin_step=None):
-        if self.__nx_version == 2:
-            for i, j in combinations(self.__g.nodes(), 2):
-                dist = self.__dist(self.__g.nodes[i]['xyz'], self.__g.nodes[j]['xyz'], bin_step)
-                self.__g.add_edge(i, j, dist=dist, pdist=PharmacophoreBase.__primes_edge[dist])
-        else:
-            for i, j in combinations(self.__g.nodes(), 2):
-                dist = self.__dist(self.__g.node[i]['xyz'], self.__g.node[j]['xyz'], bin_step)
-                self.__g.add_edge(i, j, dist=dist, pdist=PharmacophoreBase.__primes_edge[dist])
+        self.__dists = self.__dist(self.__coords[:, None, :], self.__coords[None, :, :], bin_step)
+        # binned distances must have an edge prime as when the graph was built on loading,
+        # callers (e.g. pmapper_3d.get_phf) rely on IndexError to drop such molecules
+        if self.__bin_step != 0 and self.__dists.size and self.__dists.max() >= len(PharmacophoreBase.__primes_edge):
+            raise IndexError('binned distance %i is out of range of edge primes' % self.__dists.max())
+        # python copy of the matrix for scalar lookups, they are much slower on numpy arrays
+        self.__dist_list = self.__dists.tolist()
+        self.__tokens = None
+        self.__g = None
+        self.__cache.clear()
 
     def __dist(self, coord1, coord2, bin_step=None):
-        # coord1, coord2 - tuples of (x, y, z)
+        # coord1, coord2 - arrays of (x, y, z) coordinates, distances are computed for all pairs at once
         # bin_step: None means default, 0 means no transformation, other number will use as regular
-        tmp = sum([(i - j) ** 2 for i, j in zip(coord1, coord2)]) ** 0.5
+        diff = coord1 - coord2
+        tmp = (diff[..., 0] ** 2 + diff[..., 1] ** 2 + diff[..., 2] ** 2) ** 0.5
         if bin_step == 0 or self.__bin_step == 0:
             return tmp
         elif bin_step is None:
-            return int(tmp // self.__bin_step)
+            return np.floor_divide(tmp, self.__bin_step).astype(int)
         else:
-            return int(tmp // bin_step)
+            return np.floor_divide(tmp, bin_step).astype(int)
+
+    def __get_tokens(self):
+        # tokens[i][j] is the label of the feature j and its distance to the feature i, e.g. 'A3'
+        if self.__tokens is None:
+            self.__tokens = [['%s%i' % (label_j, dist_ij) for label_j, dist_ij in zip(self.__labels, row)]
+                             for row in self.__dist_list]
+        return self.__tokens
+
+    def _get_graph(self):
+        # the graph is built once from the distance matrix and shared, get_graph returns a copy
+        if self.__g is None:
+            g = nx.Graph()
+            for i, (label, xyz) in enumerate(zip(self.__labels, self.__xyz)):
+                g.add_node(i, label=label, xyz=xyz, plabel=PharmacophoreBase.__primes_vertex[label])
+            for i, j in combinations(range(len(self.__labels)), 2):
+                if self.__bin_step == 0:
+                    g.add_edge(i, j, dist=self.__dist_list[i][j])
+                else:
+                    dist = self.__dist_list[i][j]
+                    g.add_edge(i, j, dist=dist, pdist=PharmacophoreBase.__primes_edge[dist])
+            self.__g = g
+        return self.__g
 
     # def __get_feature_signatures(self, ids=None, feature_labels=None):
     #     """
@@ -141,22 +263,12 @@ class PharmacophoreBase():
 
     def __get_canon_feature_signatures2(self, ids):
 
-        feature_labels = dict(zip(ids, (self.__g.node[i]['label'] for i in ids)))
-        feature_signatures = []
-        for i in ids:
-            sign = []
-            for j in ids:
-                if i != j:
-                    if self.__nx_version == 2:
-                        sign.append('%s%i' % (feature_labels[j], self.__g.edges[i, j]['dist']))
-                    else:
-                        sign.append('%s%i' % (feature_labels[j], self.__g.edge[i][j]['dist']))
-            feature_signatures.append(feature_labels[i] + ''.join(sorted(sign)))
-        return tuple(feature_signatures)
+        tokens = self.__get_tokens()
+        return tuple(self.__labels[i] + ''.join(sorted([tokens[i][j] for j in ids if j != i])) for i in ids)
 
     def _get_ids(self, ids=None):
         if ids is None:
-            ids = self.__g.nodes()
+            ids = range(len(self.__labels))
         return tuple(sorted(set(ids)))
 
     # def __get_graph_signature(self, ids=None):
@@ -168,6 +280,8 @@ class PharmacophoreBase():
     #     return md5(pickle.dumps(repr(s)))
 
     def __get_signature_dict(self, ids, tol):
+        if len(ids) >= PharmacophoreBase.__min_batch_features and not self.__cached and self.__can_batch():
+            return self.__get_signature_dict_batch(ids, tol)
         d = defaultdict(int)
         for qudruplet_ids in combinations(ids, min(len(ids), 4)):
             if self.__cached:
@@ -181,10 +295,206 @@ class PharmacophoreBase():
             d[res] += 1
         return d
 
+    def __can_batch(self):
+        # batch keys pack binned distances into 8 bits
+        return self.__bin_step != 0 and (len(self.__labels) < 2 or self.__dists.max() < 256)
+
+    @staticmethod
+    def __get_combination_index(n, k):
+        # (C(n, k), k) array of all combinations of k of n features in the order of combinations
+        try:
+            return PharmacophoreBase.__combination_index[(n, k)]
+        except KeyError:
+            idx = np.fromiter(chain.from_iterable(combinations(range(n), k)), dtype=np.intp).reshape(-1, k)
+            PharmacophoreBase.__combination_index[(n, k)] = idx
+            return idx
+
+    def __get_signature_dict_batch(self, ids, tol):
+        # the same counts as the loop over quadruplets in __get_signature_dict, computed for all quadruplets at once
+        ids = np.asarray(ids, dtype=np.intp)
+        keys, cache = self.__get_signature_keys_batch(ids[self.__get_combination_index(len(ids), 4)], tol)
+        uniq, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        order = np.argsort(first, kind='stable')
+        d = defaultdict(int)
+        # keep the order of the first occurrence like the loop does
+        for key, n in zip(uniq[order].tolist(), counts[order].tolist()):
+            d[cache.get_signature(key, tol)] = n
+        return d
+
+    def __get_signature_keys_batch(self, combs, tol):
+        # signatures of combinations of 3 or 4 features (rows of combs) coded as name id * 32 + stereo + 16,
+        # stereo is in [-11, 11], SignatureCache.get_signature turns a code into the signature string.
+        # Canonical names depend only on labels and binned distances of features, they are taken from
+        # the signature cache (shared by conformers of a molecule) and computed only for new combinations,
+        # without a cache they are computed for every call
+        cache = self.__signature_cache
+        shared = cache is not None
+        if not shared:
+            cache = SignatureCache()
+        k = combs.shape[1]
+
+        # size, labels and distances of features in the order of ids packed into one integer
+        key = np.full(len(combs), k, dtype=np.int64)
+        for i in range(k):
+            key = key * 8 + self.__codes[combs[:, i]]
+        for i, j in combinations(range(k), 2):
+            key = key * 256 + self.__dists[combs[:, i], combs[:, j]]
+        uniq, first, inv = np.unique(key, return_index=True, return_inverse=True)
+
+        # name id, positions of features in the canonical order and kind of the combination
+        if shared:
+            uniq = uniq.tolist()
+            info = [cache.quadruplets.get(i, (-1, 0, 0, 0, 0, 0)) for i in uniq]
+            info = np.array(info, dtype=np.int64).reshape(-1, 6)
+            missed = np.flatnonzero(info[:, 0] < 0)
+            cache.hits += len(uniq) - len(missed)
+            cache.misses += len(missed)
+            if len(missed):
+                info[missed] = self.__get_canon_names_batch(combs[first[missed]], cache)
+                cache.quadruplets.update(zip([uniq[i] for i in missed.tolist()], map(tuple, info[missed].tolist())))
+        else:
+            info = self.__get_canon_names_batch(combs[first], cache)
+        info = info[inv.reshape(-1)]
+
+        if k == 4:
+            stereo = self.__get_stereo_batch(combs, info[:, 1:5], info[:, 5], tol)
+        else:
+            stereo = 0
+        return info[:, 0] * 32 + (stereo + 16), cache
+
+    def __get_canon_names_batch(self, combs, cache):
+        # canonical names of combinations of k features as __gen_quadruplet_canon_name_stereo makes them.
+        # Feature signatures are coded by the label and sorted 'label+distance' tokens, the codes are ranked
+        # in the order of their strings, so sorting the codes sorts the names.
+        # Returns (name id, positions of features in the canonical order, kind), kind is 1 for ABCD,
+        # 2 for chiral AABB and 0 for achiral quadruplets and for combinations of less than 4 features
+        k = combs.shape[1]
+        tokens = self.__get_tokens()
+        token_names = sorted(set(chain.from_iterable(tokens)))
+        token_rank = {t: i for i, t in enumerate(token_names)}
+        token_ids = np.array([[token_rank[t] for t in row] for row in tokens], dtype=np.int64)
+        n_tokens = len(token_names)
+
+        others = np.array([[j for j in range(k) if j != i] for i in range(k)])
+        sign = np.sort(token_ids[combs[:, :, None], combs[:, others]], axis=2)
+        codes = self.__codes[combs].astype(np.int64)
+        for i in range(k - 1):
+            codes = codes * n_tokens + sign[:, :, i]
+        uniq, inv = np.unique(codes, return_inverse=True)
+        labels = sorted(PharmacophoreBase.__label_codes)
+        parts = [[labels[i] for i in (uniq // n_tokens ** (k - 1)).tolist()]]
+        parts += [[token_names[i] for i in (uniq // n_tokens ** (k - 2 - j) % n_tokens).tolist()] for j in range(k - 1)]
+        names = [''.join(i) for i in zip(*parts)]
+        order = sorted(range(len(names)), key=names.__getitem__)
+        names = [names[i] for i in order]
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        rank = rank[inv.reshape(-1)].reshape(-1, k)
+        srt = np.sort(rank, axis=1)
+
+        res = np.zeros((len(combs), 6), dtype=np.int64)
+        uniq, inv = np.unique(srt, axis=0, return_inverse=True)
+        name_ids = cache.get_name_ids(['|'.join([names[j] for j in row]) for row in uniq.tolist()])
+        res[:, 0] = np.array(name_ids, dtype=np.int64)[inv.reshape(-1)]
+        if k < 4:
+            return res
+
+        # system AAAA, AAAB or AABC is achiral, only ABCD and AABB ones can be chiral
+        eq = srt[:, 1:] == srt[:, :-1]
+        abcd = ~eq.any(axis=1)
+        aabb = eq[:, 0] & ~eq[:, 1] & eq[:, 2]
+
+        # features in the order of their names, ties keep the order of ids
+        pos = np.argsort(rank, axis=1, kind='stable')
+        ids = np.take_along_axis(combs, pos, axis=1)
+        dists = self.__dists
+        d02, d03 = dists[ids[:, 0], ids[:, 2]], dists[ids[:, 0], ids[:, 3]]
+        d12, d13 = dists[ids[:, 1], ids[:, 2]], dists[ids[:, 1], ids[:, 3]]
+        aabb &= ~(((d02 == d03) & (d12 == d13)) | ((d02 == d12) & (d03 != d13)))
+        swap = aabb & (d02 > d03)
+        pos[swap, 2], pos[swap, 3] = pos[swap, 3], pos[swap, 2]
+
+        res[:, 1:5] = pos
+        res[:, 5] = np.where(abcd, 1, np.where(aabb, 2, 0))
+        return res
+
+    def __get_stereo_batch(self, quads, pos, kind, tol):
+        # stereo of quadruplets, pos are positions of features in the canonical order
+        stereo = np.zeros(len(quads), dtype=np.int64)
+        coords = self.__coords[quads]
+
+        # quadruplets with less than 4 unique coordinates are achiral
+        chiral = kind > 0
+        for i, j in combinations(range(4), 2):
+            chiral &= (coords[:, i] != coords[:, j]).any(axis=1)
+        chiral = np.flatnonzero(chiral)
+
+        c = np.take_along_axis(coords[chiral], pos[chiral][:, :, None], axis=1)
+        stereo[chiral] = self.__get_quadruplet_stereo_batch(c, tol)
+        sel = kind[chiral] == 2
+        # modifies the sign to distinguish trapeze and parallelogram-like quadruplets
+        stereo[chiral[sel]] += 10 * self.__sign_dihedral_angle_batch(c[sel][:, [0, 2, 3, 1]])
+        return stereo
+
+    @staticmethod
+    def __get_quadruplet_stereo_batch(coord, tol=0):
+        # coord - (n, 4, 3) array, signs of __get_quadruplet_stereo for quadruplets with 4 unique points
+        b = coord[:, 1:] - coord[:, :1]
+        d = (b[:, 0, 0] * (b[:, 1, 1] * b[:, 2, 2] - b[:, 2, 1] * b[:, 1, 2])
+             - b[:, 1, 0] * (b[:, 0, 1] * b[:, 2, 2] - b[:, 2, 1] * b[:, 0, 2])
+             + b[:, 2, 0] * (b[:, 0, 1] * b[:, 1, 2] - b[:, 1, 1] * b[:, 0, 2]))
+        res = np.sign(d).astype(np.int64)
+        if tol:
+            for i in np.flatnonzero(res).tolist():
+                if PharmacophoreBase.__check_tolerance(coord[i], tol):
+                    res[i] = 0
+        return res
+
+    @staticmethod
+    def __sign_dihedral_angle_batch(coords):
+        # coords - (n, 4, 3) array, the same as sign_dihedral_angle of __gen_quadruplet_canon_name_stereo
+        b1 = coords[:, 0] - coords[:, 1]
+        b2 = coords[:, 1] - coords[:, 2]
+        b3 = coords[:, 2] - coords[:, 3]
+        n1 = (b1[:, 1] * b2[:, 2] - b1[:, 2] * b2[:, 1], -(b1[:, 0] * b2[:, 2] - b1[:, 2] * b2[:, 0]),
+              b1[:, 0] * b2[:, 1] - b1[:, 1] * b2[:, 0])
+        n2 = (b2[:, 1] * b3[:, 2] - b2[:, 2] * b3[:, 1], -(b2[:, 0] * b3[:, 2] - b2[:, 2] * b3[:, 0]),
+              b2[:, 0] * b3[:, 1] - b2[:, 1] * b3[:, 0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos_angle = (n1[0] * n2[0] + n1[1] * n2[1] + n1[2] * n2[2]) / \
+                        (np.sqrt(n1[0] * n1[0] + n1[1] * n1[1] + n1[2] * n1[2]) +
+                         np.sqrt(n2[0] * n2[0] + n2[1] * n2[1] + n2[2] * n2[2]))
+        return np.sign(np.nan_to_num(cos_angle)).astype(np.int64)
+
     def __get_full_hash(self, ids=None, tol=0):
         d = self.__get_signature_dict(ids, tol)
         return md5(pickle.dumps(str(tuple(sorted(d.items()))))).hexdigest()
 
+    def __get_int_hash(self, ids=None, tol=0):
+        d = self.__get_signature_dict(ids, tol)
+        return _int_hash(str(tuple(sorted(d.items()))))
+
+    def __get_fp_hashes(self, min_features=3, max_features=3, tol=0):
+        # 64-bit hashes of feature combinations in the order of iterate_pharm,
+        # combinations of 3 and 4 features are computed in batch
+        ids = self._get_ids()
+        if max_features is None:
+            max_features = len(ids)
+        else:
+            max_features = min(max_features, len(ids))
+        hashes = []
+        for n in range(min_features, max_features + 1):
+            if n in (3, 4) and self.__can_batch():
+                combs = np.asarray(ids, dtype=np.intp)[self.__get_combination_index(len(ids), n)]
+                keys, cache = self.__get_signature_keys_batch(combs, tol)
+                uniq, inv = np.unique(keys, return_inverse=True)
+                h = np.array([cache.get_hash(key, tol) for key in uniq.tolist()], dtype=np.uint64)
+                hashes.append(h[inv.reshape(-1)])
+            else:
+                hashes.append(np.array([self.__get_int_hash(comb, tol) for comb in combinations(ids, n)],
+                                       dtype=np.uint64))
+        return np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+
     def __gen_quadruplet_canon_name_stereo(self, feature_ids, tol=0):
         # return canon quadruplet signature and stereo
 
@@ -211,7 +521,7 @@ class PharmacophoreBase():
         feature_names = self.__get_canon_feature_signatures2(feature_ids)
 
         # less than 4 unique feature coordinates
-        if len(set(tuple(coords for (label, coords) in self.get_feature_coords(feature_ids)))) < 4:
+        if len(set(self.__xyz[i] for i in feature_ids)) < 4:
 
             stereo = 0
 
@@ -226,46 +536,25 @@ class PharmacophoreBase():
             else:
 
                 names, ids = self.__sort_two_lists(feature_names, feature_ids)
-
-                if self.__nx_version == 2:
-
-                    if len(c) == len(feature_names):  # system ABCD
-                        stereo = self.__get_quadruplet_stereo(coord=tuple(self.__g.nodes[i]['xyz'] for i in ids), tol=tol)
-
-                    else:  # system AABB
-
-                        # if A1-B1 == A1-B2 and A2-B1 == A2-B2 distances or A1-B1 == A2-B1 and A1-B2 == A2-B2 then simplex is achiral
-                        if (self.__g.edges[ids[0], ids[2]]['dist'] == self.__g.edges[ids[0], ids[3]]['dist'] and
-                            self.__g.edges[ids[1], ids[2]]['dist'] == self.__g.edges[ids[1], ids[3]]['dist']) or \
-                           (self.__g.edges[ids[0], ids[2]]['dist'] == self.__g.edges[ids[1], ids[2]]['dist'] and
-                            self.__g.edges[ids[0], ids[3]]['dist'] - self.__g.edges[ids[1], ids[3]]['dist']):
-                            stereo = 0
-                        else:  # swap B vertices to put on the higher position B vertex with a shorter distance to the first A vertex
-                            if self.__g.edges[ids[0], ids[2]]['dist'] > self.__g.edges[ids[0], ids[3]]['dist']:
-                                ids[2], ids[3] = ids[3], ids[2]
-                            stereo = self.__get_quadruplet_stereo(coord=tuple(self.__g.nodes[i]['xyz'] for i in ids), tol=tol)
-                            # modifies the sign to distinguish trapeze and parallelogram-like quadruplets
-                            stereo += 10 * sign_dihedral_angle(tuple(self.__g.nodes[ids[i]]['xyz'] for i in [0, 2, 3, 1]))
-
-                else:
-
-                    if len(c) == len(feature_names):   # system ABCD
-                        stereo = self.__get_quadruplet_stereo(coord=tuple(self.__g.node[i]['xyz'] for i in ids), tol=tol)
-
-                    else:   # system AABB
-
-                        # if A1-B1 == A1-B2 and A2-B1 == A2-B2 distances or A1-B1 == A2-B1 and A1-B2 == A2-B2 then simplex is achiral
-                        if (self.__g.edge[ids[0]][ids[2]]['dist'] == self.__g.edge[ids[0]][ids[3]]['dist'] and
-                            self.__g.edge[ids[1]][ids[2]]['dist'] == self.__g.edge[ids[1]][ids[3]]['dist']) or \
-                           (self.__g.edge[ids[0]][ids[2]]['dist'] == self.__g.edge[ids[1]][ids[2]]['dist'] and
-                            self.__g.edge[ids[0]][ids[3]]['dist'] - self.__g.edge[ids[1]][ids[3]]['dist']):
-                            stereo = 0
-                        else: # swap B vertices to put on the higher position B vertex with a shorter distance to the first A vertex
-                            if self.__g.edge[ids[0]][ids[2]]['dist'] > self.__g.edge[ids[0]][ids[3]]['dist']:
-                                ids[2], ids[3] = ids[3], ids[2]
-                            stereo = self.__get_quadruplet_stereo(coord=tuple(self.__g.node[i]['xyz'] for i in ids), tol=tol)
-                            # modifies the sign to distinguish trapeze and parallelogram-like quadruplets
-                            stereo += 10 * sign_dihedral_angle(tuple(self.__g.node[ids[i]]['xyz'] for i in [0, 2, 3, 1]))
+                dists = self.__dist_list
+
+                if len(c) == len(feature_names):  # system ABCD
+                    stereo = self.__get_quadruplet_stereo(coord=tuple(self.__xyz[i] for i in ids), tol=tol)
+
+                else:  # system AABB
+
+                    # if A1-B1 == A1-B2 and A2-B1 == A2-B2 distances or A1-B1 == A2-B1 and A1-B2 == A2-B2 then simplex is achiral
+                    if (dists[ids[0]][ids[2]] == dists[ids[0]][ids[3]] and
+                        dists[ids[1]][ids[2]] == dists[ids[1]][ids[3]]) or \
+                       (dists[ids[0]][ids[2]] == dists[ids[1]][ids[2]] and
+                        dists[ids[0]][ids[3]] - dists[ids[1]][ids[3]]):
+                        stereo = 0
+                    else:  # swap B vertices to put on the higher position B vertex with a shorter distance to the first A vertex
+                        if dists[ids[0]][ids[2]] > dists[ids[0]][ids[3]]:
+                            ids[2], ids[3] = ids[3], ids[2]
+                        stereo = self.__get_quadruplet_stereo(coord=tuple(self.__xyz[i] for i in ids), tol=tol)
+                        # modifies the sign to distinguish trapeze and parallelogram-like quadruplets
+                        stereo += 10 * sign_dihedral_angle(tuple(self.__xyz[ids[i]] for i in [0, 2, 3, 1]))
 
         return '|'.join(sorted(feature_names)), stereo
 
@@ -276,10 +565,9 @@ class PharmacophoreBase():
         return map(list, zip(*paired_sorted))  # two lists
 
     @staticmethod
-    def __get_quadruplet_stereo(coord, tol=0):
-        # coord - tuple of tuples containing coordinates of four points in a specific order
-        # ((x1, y1, z1), (x2, y2, z2), (x3, y3, z3), (x4, y4, z4))
-        # triple product is calculated for 1-2, 1-3 and 1-4 vectors
+    def __check_tolerance(p, tol=0):
+        # return True if quadruplet within the tolerance range
+        # look for a minimal angle regardless sign
 
         def get_angles(p, k):
             # get the angles of the lines which ends in k-point and a plane
@@ -293,23 +581,26 @@ class PharmacophoreBase():
             dist = (np.dot(cp, p[k]) - d) / sqrt(sum(cp ** 2))  # signed distance to plane
             return tuple(180 * asin(dist / np.linalg.norm(p[k] - pp[i])) / pi for i in range(3))
 
-        def check_tolerance(p, tol=0):
-            # return True if quadruplet within the tolerance range
-            # look for a minimal angle regardless sign
-            for i in range(4):
-                res = get_angles(np.array(p), i)
-                if any(-tol <= value <= tol for value in res):
-                    return True
-            return False
-            # res = np.array([get_angles(np.array(p), i) for i in range(4)])
-            # return ((-tol <= res) & (res <= tol)).any()
+        for i in range(4):
+            res = get_angles(np.array(p), i)
+            if any(-tol <= value <= tol for value in res):
+                return True
+        return False
+        # res = np.array([get_angles(np.array(p), i) for i in range(4)])
+        # return ((-tol <= res) & (res <= tol)).any()
+
+    @staticmethod
+    def __get_quadruplet_stereo(coord, tol=0):
+        # coord - tuple of tuples containing coordinates of four points in a specific order
+        # ((x1, y1, z1), (x2, y2, z2), (x3, y3, z3), (x4, y4, z4))
+        # triple product is calculated for 1-2, 1-3 and 1-4 vectors
 
         def det(a):
             return (a[0][0] * (a[1][1] * a[2][2] - a[2][1] * a[1][2])
                     - a[1][0] * (a[0][1] * a[2][2] - a[2][1] * a[0][2])
                     + a[2][0] * (a[0][1] * a[1][2] - a[1][1] * a[0][2]))
 
-        if len(set(coord)) < 4 or tol and check_tolerance(coord, tol):
+        if len(set(coord)) < 4 or tol and PharmacophoreBase.__check_tolerance(coord, tol):
             return 0
         else:
             # calc difference between coord of the first point and all other points
@@ -327,20 +618,20 @@ class PharmacophoreBase():
         return self.__bin_step
 
     def get_graph(self):
-        return self.__g.copy()
+        return self._get_graph().copy()
 
     def get_features_count(self):
-        data = self.__g.nodes(data=True)
-        return Counter([item[1]['label'] for item in data])
+        return Counter(self.__labels)
 
     def get_signature_md5(self, ids=None, tol=0):
         return self.__get_full_hash(self._get_ids(ids), tol)
 
     def get_feature_coords(self, ids=None):
         if ids is None:
-            return [(v['label'], v['xyz']) for k, v in self.__g.nodes(data=True)]
+            return list(zip(self.__labels, self.__xyz))
         else:
-            return [(v['label'], v['xyz']) for k, v in self.__g.nodes(data=True) if k in set(ids)]
+            ids = set(ids)
+            return [(label, xyz) for k, (label, xyz) in enumerate(zip(self.__labels, self.__xyz)) if k in ids]
 
     def get_mirror_pharmacophore(self):
         p = Pharmacophore()
@@ -358,9 +649,9 @@ class PharmacophoreBase():
     def iterate_pharm(self, min_features=1, max_features=None, tol=0, return_feature_ids=True):
         ids = self._get_ids()
         if max_features is None:
-            max_features = len(self.__g.nodes())
+            max_features = len(self.__labels)
         else:
-            max_features = min(max_features, len(self.__g.nodes()))
+            max_features = min(max_features, len(self.__labels))
         for n in range(min_features, max_features + 1):
             for comb in combinations(ids, n):
                 if return_feature_ids:
@@ -379,7 +670,7 @@ class PharmacophoreBase():
         """
         visited_id_comb = set()
         for ids in fix_ids:
-            add_ids = set(self.__g.nodes()).difference(ids)
+            add_ids = set(range(len(self.__labels))).difference(ids)
             for add_id in add_ids:
                 i = tuple(sorted(tuple(ids) + (add_id, )))
                 if i not in visited_id_comb:
@@ -389,7 +680,16 @@ class PharmacophoreBase():
                     else:
                         yield self.__get_full_hash(ids=i, tol=tol)
 
-    def get_fp(self, min_features=3, max_features=3, tol=0, nbits=2048, activate_bits=1):
+    def get_fp(self, min_features=3, max_features=3, tol=0, nbits=2048, activate_bits=1, legacy=True):
+        """
+        Bits of hashed signatures of all combinations of min_features to max_features features.
+        legacy=True (default) gives the same bits as older versions: md5 of a signature seeds random.randrange.
+        legacy=False uses a much faster 64-bit hash of signatures, bits differ from the legacy ones, so fingerprints
+        of both kinds must not be mixed in one dataset or compared with models trained on the other kind.
+        """
+        if not legacy:
+            return set(_hash_bits(self.__get_fp_hashes(min_features, max_features, tol), nbits,
+                                  activate_bits).ravel().tolist())
         output = set()
         for h in self.iterate_pharm(min_features, max_features, tol, False):
             random.seed(int(h, 16))
@@ -397,10 +697,15 @@ class PharmacophoreBase():
                 output.add(random.randrange(nbits))
         return output
 
-    def get_fp2(self, min_features=3, max_features=3, tol=(0, ), nbits=(2048, ), activate_bits=(1, )):
-        # return dict of {(nbits, activate_bits): {bit set}, ...}
+    def get_fp2(self, min_features=3, max_features=3, tol=(0, ), nbits=(2048, ), activate_bits=(1, ), legacy=True):
+        # return dict of {(nbits, activate_bits, tol): {bit set}, ...}, legacy as in get_fp
         output = defaultdict(set)
         for tol_ in tol:
+            if not legacy:
+                hashes = self.__get_fp_hashes(min_features, max_features, tol_)
+                for nbits_, act_bits_ in product(nbits, activate_bits):
+                    output[(nbits_, act_bits_, tol_)].update(_hash_bits(hashes, nbits_, act_bits_).ravel().tolist())
+                continue
             for h in self.iterate_pharm(min_features, max_features, tol_, False):
                 seed = int(h, 16)
                 for nbits_, act_bits_ in product(nbits, activate_bits):
@@ -424,8 +729,10 @@ class PharmacophoreMol(PharmacophoreBase):
 
     __feat_dict_mol = {'A': 89, 'P': 15, 'N': 7, 'H': 1, 'D': 66, 'a': 10}
 
-    def __init__(self, bin_step=1, cached=False):
-        super().__init__(bin_step, cached)
+    __slots__ = ()
+
+    def __init__(self, bin_step=1, cached=False, signature_cache=None):
+        super().__init__(bin_step, cached, signature_cache)
 
     def get_mol(self, ids=None):
         pmol = Chem.RWMol()
@@ -442,30 +749,20 @@ class PharmacophoreMol(PharmacophoreBase):
 
 class PharmacophoreMatch(PharmacophoreMol):
 
-    def __init__(self, bin_step=1, cached=False):
-        super().__init__(bin_step, cached)
-        self.__nm = iso.categorical_node_match('label', '_')
-        self.__em = iso.numerical_edge_match('dist', 0)
-
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['_PharmacophoreMatch__nm']
-        del state['_PharmacophoreMatch__em']
-        return state
+    # matchers are closures, they are kept on the class to leave instances picklable
+    __nm = staticmethod(iso.categorical_node_match('label', '_'))
+    __em = staticmethod(iso.numerical_edge_match('dist', 0))
 
-    def __setstate__(self, state):
-        self.__dict__.update(state)
-        self.__nm = iso.categorical_node_match('label', '_')
-        self.__em = iso.numerical_edge_match('dist', 0)
+    __slots__ = ()
 
     def __get_transformation_matrix(self, model, mapping):
         return rdMolAlign.GetAlignmentTransform(self.get_mol(), self.get_mol(model), atomMap=tuple(mapping.items()))[1]
 
     def __fit_graph(self, model):
         if self.get_bin_step() != 0:
-            gm = iso.GraphMatcher(self._PharmacophoreBase__g, model, node_match=self.__nm, edge_match=self.__em)
+            gm = iso.GraphMatcher(self._get_graph(), model, node_match=self.__nm, edge_match=self.__em)
         else:
-            gm = iso.GraphMatcher(self._PharmacophoreBase__g, model, node_match=self.__nm, edge_match=iso.numerical_edge_match('dist', 0, atol=0.75))
+            gm = iso.GraphMatcher(self._get_graph(), model, node_match=self.__nm, edge_match=iso.numerical_edge_match('dist', 0, atol=0.75))
         return gm
 
     def fit_model(self, model, n_omitted=0, essential_features=None, tol=0, get_transform_matrix=False):
@@ -500,7 +797,7 @@ class PharmacophoreMatch(PharmacophoreMol):
         if n_omitted:
             for n in range(1, n_omitted + 1):
                 for i in combinations(optional_features, n):
-                    gm = self.__fit_graph(model._PharmacophoreBase__g.subgraph(ids.difference(i)))
+                    gm = self.__fit_graph(model._get_graph().subgraph(ids.difference(i)))
                     for j, mapping in enumerate(gm.subgraph_isomorphisms_iter()):
                         if j == 0:
                             ref = model.get_signature_md5(ids=tuple(mapping.values()), tol=tol)
@@ -510,7 +807,7 @@ class PharmacophoreMatch(PharmacophoreMol):
                             else:
                                 return tuple(mapping.values())
         else:
-            gm = self.__fit_graph(model._PharmacophoreBase__g)
+            gm = self.__fit_graph(model._get_graph())
             for j, mapping in enumerate(gm.subgraph_isomorphisms_iter()):
                 if j == 0:
                     ref = model.get_signature_md5(tol=tol)
@@ -526,6 +823,8 @@ class Pharmacophore(PharmacophoreMatch):
 
     __feat_dict_ls = {"A": "HBA", "H": "H", "D": "HBD", "P": "PI", "N": "NI", "a": "AR"}
 
+    __slots__ = ()
+
     def load_from_smarts(self, mol, smarts):
         features_atom_ids = self._get_features_atom_ids(mol, smarts)
         self.load_from_atom_ids(mol, features_atom_ids)
@@ -1,9 +1,9 @@
 import os
 import argparse
-import collections
 import pkg_resources
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from time import time
 from multiprocessing import Pool
 #from sklearn.externals import joblib
@@ -14,26 +14,29 @@ from .read_input import read_input
 smarts = P.read_smarts_feature_file(pkg_resources.resource_filename(__name__, 'pmapper/smarts_features.txt'))
 
 
-def get_phf(mol):
-    p = P.Pharmacophore()
+# conformers of one molecule are consecutive rows, they share the signature cache in a worker
+_signature_cache = (None, None)
+
+
+def get_phf(mol, signature_cache=None):
+    p = P.Pharmacophore(signature_cache=signature_cache)
     try:
         p.load_from_smarts(mol, smarts)
-        phf_descript = pd.Series(p.get_descriptors(), dtype=np.uint8)
+        phf_descript = p.get_descriptors()
     except IndexError:
         # with open(log,'a') as out_log:
         #     out_log.write(name)
         # print('phf error')
         return None
 
-    # phf_descript['mol_id'] = mol_id
-    # phf_descript['act'] = act
-    # phf_descript['mol_title'] = name
-
     return phf_descript
 
 def get_phf_for_mol(mol_tup):
+    global _signature_cache
     mol, mol_title, act, mol_id = mol_tup
-    phf_descr = get_phf(mol)
+    if _signature_cache[0] != mol_id:
+        _signature_cache = (mol_id, P.SignatureCache())
+    phf_descr = get_phf(mol, _signature_cache[1])
 
     if phf_descr is None:
         #print('phf error', mol_title)
@@ -55,59 +58,13 @@ def get_mols(fname):
     return mols
 
 
-def get_phf_clean(fname, ncpu, part=0.05):
-    p = Pool(ncpu, maxtasksperchild=50)
-
-    mols = get_mols(fname=fname)
-    if mols is None:
-        print('Wrong format or file')
-        return None
-
-    phf_dict = collections.Counter()
-    mol_count = 0
-
-    for res in p.imap_unordered(get_phf_for_mol, mols, chunksize=10):
-        if not res is None:
-            mol_count += 1
-            phf = res[0]
-            for phf_ind in phf.index:
-                phf_dict[phf_ind] += 1
-
-    p.close()
-    p.join()
-
-    phf_clean_ind = (np.array(list(phf_dict.values())) >= 2) & (np.array(list(phf_dict.values())) >= mol_count*part)
-    phf_clean = np.array(list(phf_dict.keys()))[phf_clean_ind]
-
-    #print('Preprocess columns:', len(phf_clean))
-    return phf_clean
-
-def add_uniq_col(fname, ncpu, col_clean):
-    p = Pool(ncpu, maxtasksperchild=50)
-    mols = get_mols(fname=fname)
-
-    if mols is None:
-        print('Wrong format or file')
-        return None
-
-    cols_add = set()
-
-    for res in p.imap_unordered(get_phf_for_mol, mols, chunksize=10):
-        phf_descr = res[0]
-        if all(phf_descr.reindex(col_clean, fill_value=0).astype(np.uint8).values == 0):
-            cols_add.update(phf_descr.index)
-
-    #print('Additional columns:', len(cols_add))
-
-    result_cols = np.array(list(set(col_clean) | cols_add))
-    # print(result_cols)
-
-    return result_cols
+def select_columns(counts, n_rows, part=0.05):
+    # descriptors occurred in at least 2 rows and in at least part of all rows
+    return np.flatnonzero((counts >= 2) & (counts >= n_rows * part))
 
 
 def main(fname=None, ncpu=10, path=None, col_clean=None, del_undef=True):
 # col_clean can use for test set
-    p = Pool(ncpu, maxtasksperchild=50)
     start = time()
 
     if path is None:
@@ -119,36 +76,61 @@ def main(fname=None, ncpu=10, path=None, col_clean=None, del_undef=True):
         return None
 
     out_fname = os.path.join(path, 'PhFprPmapper_{f_name}_proc.pkl'.format(f_name=os.path.basename(fname).split('.')[0]))
-    phf_res = [[],[]]
+
+    # one pass: per-row descriptors are cached as sparse (column id, count) arrays
+    # and the number of rows containing every descriptor is counted on the way
+    vocab = {}
+    counts = np.zeros(0, dtype=np.int64)
+    meta, indptr, indices, values = [], [0], [], []
+    with Pool(ncpu, maxtasksperchild=50) as p:
+        for res in p.imap(get_phf_for_mol, mols, chunksize=10):
+            if res is None:
+                continue
+            phf_descr, mol_title, act, mol_id = res
+            idx = np.fromiter((vocab.setdefault(k, len(vocab)) for k in phf_descr), dtype=np.int64,
+                              count=len(phf_descr))
+            if len(vocab) > len(counts):
+                counts = np.concatenate([counts, np.zeros(max(len(vocab) - len(counts), len(counts)), dtype=np.int64)])
+            counts[idx] += 1
+
+            meta.append([mol_title, act, mol_id])
+            indices.append(idx)
+            values.append(np.fromiter(phf_descr.values(), dtype=np.int64, count=len(phf_descr)))
+            indptr.append(indptr[-1] + len(idx))
+
+    names = np.array(list(vocab), dtype=object)
+    counts = counts[:len(vocab)]
+    # counts are stored as uint16, a larger one is an error rather than a silently clipped value
+    values = np.concatenate(values or [np.zeros(0, np.int64)])
+    if len(values) and values.max() > np.iinfo(np.uint16).max:
+        raise ValueError('Pmapper descriptor count {} does not fit uint16: {}'.format(values.max(), fname))
+    x = sparse.csr_matrix((values.astype(np.uint16), np.concatenate(indices or [np.zeros(0, np.int64)]), indptr),
+                          shape=(len(meta), len(vocab)))
 
     #select common phf_descr - quantity of mols dataset >= 5%
     if col_clean is None:
-        col_clean = get_phf_clean(fname=fname, ncpu=ncpu, part=0.05)
-        if len(col_clean) == 0:
+        col_ids = select_columns(counts, len(meta), part=0.05)
+        if len(col_ids) == 0:
             print('Descriptors selection error. Clean col = 0. Threshold was lowered. To get descriptors if quantity > 2 ')
-            col_clean = get_phf_clean(fname=fname, ncpu=ncpu, part=0)
-        # col_clean = add_uniq_col(fname, ncpu, col_clean)
+            col_ids = select_columns(counts, len(meta), part=0)
+        col_clean = names[col_ids]
+        x = x[:, col_ids]
+    else:
+        # descriptors of col_clean never seen here are zero columns
+        col_clean = np.asarray(col_clean)
+        x = sparse.hstack([x, sparse.csr_matrix((len(meta), 1), dtype=np.uint16)]).tocsr()
+        x = x[:, [vocab.get(c, len(vocab)) for c in col_clean]]
 
     #print('clean', time()-start, 'sec')
 
-    for res in p.imap_unordered(get_phf_for_mol, mols, chunksize=10):
-        if not res is None:
-            phf_descr, mol_title, act, mol_id = res
-            phf_res[0].append([mol_title, act, mol_id])
-            phf_res[1].append(phf_descr.reindex(col_clean, fill_value=0).astype(np.uint8).values)
-
-    p.close()
-    p.join()
-
-    phf = pd.DataFrame(phf_res[1], columns=col_clean).merge(pd.DataFrame(phf_res[0], columns=['mol_title', 'act', 'mol_id']), left_index=True, right_index=True,
-                                                            copy=False)
+    phf = pd.concat([pd.DataFrame(x.toarray(), columns=col_clean),
+                     pd.DataFrame(meta, columns=['mol_title', 'act', 'mol_id'])], axis=1)
     # print(sys.getsizeof(phf))
     #print('phf columns', len(col_clean))
 
     if del_undef:
         mol_ish = phf.loc(axis='columns')['mol_id'].unique()
-        mask_def_mol = phf.drop(axis='columns', labels=['mol_title', 'act', 'mol_id']).apply(axis='columns',
-                                                                                            func=lambda x: False if all(x == 0) else True)
+        mask_def_mol = np.asarray(x.getnnz(axis=1) > 0)
 
         mols_del = np.setdiff1d(mol_ish, phf.loc(axis='index')[mask_def_mol]['mol_id'].unique()).tolist()
         #print('Mols for del', mols_del)
@@ -5,18 +5,23 @@ import random
 import itertools
 from multiprocessing import Pool, cpu_count
 from collections import defaultdict, Counter
+import numpy as np
+from scipy import sparse
 
 from .read_input import read_input
 from pmapper.utils import load_multi_conf_mol
+from .pmapper.pharmacophore import Pharmacophore, SignatureCache
 
 
 class SvmSaver:
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, flush_every=1000):
         self.__fname = file_name
         self.__varnames_fname = os.path.splitext(file_name)[0] + '.colnames'
         self.__molnames_fname = os.path.splitext(file_name)[0] + '.rownames'
-        self.__varnames = []
+        self.__varnames = dict()  # varname: column index
+        self.__flush_every = flush_every
+        self.__rows, self.__molnames, self.__new_varnames = [], [], []
         if os.path.isfile(self.__fname):
             os.remove(self.__fname)
         if os.path.isfile(self.__molnames_fname):
@@ -26,40 +31,61 @@ class SvmSaver:
 
     def save_mol_descriptors(self, mol_name, mol_descr_dict):
 
-        values = []
+        if not mol_descr_dict:  # values can be empty if all descriptors are zero
+            return tuple()
 
-        for i, varname in enumerate(self.__varnames):
-            if varname in mol_descr_dict:
-                values.append((i, mol_descr_dict[varname]))
+        for varname in sorted(set(mol_descr_dict).difference(self.__varnames)):
+            self.__varnames[varname] = len(self.__varnames)
+            self.__new_varnames.append(varname)
 
-        new_varnames = list(sorted(set(mol_descr_dict) - set(self.__varnames)))
-        for i, varname in enumerate(new_varnames):
-            values.append((len(self.__varnames) + i, mol_descr_dict[varname]))
+        values = sorted((self.__varnames[varname], v) for varname, v in mol_descr_dict.items())
+        self.__molnames.append(mol_name)
+        self.__rows.append(' '.join('%i:%i' % (i, v) for i, v in values))
+        if len(self.__rows) >= self.__flush_every:
+            self.flush()
 
-        if values:  # values can be empty if all descriptors are zero
-
-            self.__varnames.extend(new_varnames)
+        return tuple(i for i, v in values)
 
+    def flush(self):
+        if self.__rows:
             with open(self.__molnames_fname, 'at') as f:
-                f.write(mol_name + '\n')
-
-            if new_varnames:
-                with open(self.__varnames_fname, 'at') as f:
-                    f.write('\n'.join(new_varnames) + '\n')
-
+                f.write('\n'.join(self.__molnames) + '\n')
             with open(self.__fname, 'at') as f:
-                values = sorted(values)
-                values_str = ('%i:%i' % (i, v) for i, v in values)
-                f.write(' '.join(values_str) + '\n')
-
-            return tuple(i for i, v in values)
-
-        return tuple()
+                f.write('\n'.join(self.__rows) + '\n')
+        if self.__new_varnames:
+            with open(self.__varnames_fname, 'at') as f:
+                f.write('\n'.join(self.__new_varnames) + '\n')
+        self.__rows, self.__molnames, self.__new_varnames = [], [], []
+
+
+def read_svm(file_name):
+    """
+    Reads an SvmSaver output (.svm, .rownames, .colnames) into a scipy CSR matrix.
+    :return: (csr matrix, row names, column names)
+    """
+    with open(os.path.splitext(file_name)[0] + '.colnames') as f:
+        colnames = f.read().splitlines()
+    with open(os.path.splitext(file_name)[0] + '.rownames') as f:
+        rownames = f.read().splitlines()
+    with open(file_name) as f:
+        lines = f.read().splitlines()
+
+    indptr = np.zeros(len(lines) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([line.count(':') for line in lines])
+    pairs = np.array(' '.join(lines).replace(':', ' ').split(), dtype=np.int64).reshape(-1, 2)
+    x = sparse.csr_matrix((pairs[:, 1], pairs[:, 0], indptr), shape=(len(lines), len(colnames)))
+    return x, rownames, colnames
 
 
 def process_mol(mol, mol_title):
-    ps = load_multi_conf_mol(mol)
-    res = [p.get_descriptors() for p in ps]
+    # features are found by the pmapper package with its own definitions, signatures are computed by the bundled
+    # Pharmacophore with one cache shared by all conformers, keys end with the bin step as pmapper writes them
+    cache = SignatureCache()
+    res = []
+    for p in load_multi_conf_mol(mol):
+        q = Pharmacophore(p.get_bin_step(), signature_cache=cache)
+        q.load_from_feature_coords(p.get_feature_coords())
+        res.append({'%s|%s' % (k, q.get_bin_step()): v for k, v in q.get_descriptors().items()})
     ids = [c.GetId() for c in mol.GetConformers()]
     ids, res = zip(*sorted(zip(ids, res)))  # reorder output by conf ids
     return mol_title, res
@@ -69,7 +95,7 @@ def process_mol_map(items):
     return process_mol(*items)
 
 
-def calc_pmapper_descriptors(input, output, remove=False, keep_temp=False, ncpu=1, verbose=False):
+def calc_pmapper_descriptors(input, output, remove=False, keep_temp=False, ncpu=1, verbose=False, flush_every=1000):
 
     if remove < 0 or remove > 1:
         raise ValueError('Value of the "remove" argument is out of range [0, 1]')
@@ -77,7 +103,7 @@ def calc_pmapper_descriptors(input, output, remove=False, keep_temp=False, ncpu=
     pool = Pool(max(min(ncpu, cpu_count()), 1))
 
     tmp_fname = os.path.splitext(output)[0] + '.' + ''.join(random.sample(string.ascii_lowercase, 6)) + '.svm'
-    svm = SvmSaver(tmp_fname)
+    svm = SvmSaver(tmp_fname, flush_every=flush_every)
 
     stat = defaultdict(set)
 
@@ -91,6 +117,7 @@ def calc_pmapper_descriptors(input, output, remove=False, keep_temp=False, ncpu=
         if verbose and i % 10 == 0:
             sys.stderr.write(f'\r{i} molecule records were processed')
     sys.stderr.write('\n')
+    svm.flush()
 
     if remove == 0:  # if no remove - rename temp files to output files
         os.rename(tmp_fname, output)
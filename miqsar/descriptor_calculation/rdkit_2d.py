@@ -1,48 +1,69 @@
 import os
 import argparse
+from itertools import islice
+import numpy as np
 import pandas as pd
 from multiprocessing import Pool
 from rdkit.Chem import Descriptors
 from .read_input import read_input
 from .read_input import calc_max_tau
+from .descriptor_store import write_frame, StoreWriter
 
 def _rdkit_2d(mol_id_input):
     mol, name, act, _ = mol_id_input
-    tmp = pd.DataFrame()
-    for k, f in Descriptors._descList:
-        tmp.loc[name, k] = f(mol)
-    tmp = tmp[tmp <= 10 ** 35]
-    tmp.loc[name, 'mol_id'] = name
-    tmp.loc[name, 'act'] = act
-    return tmp
+    row = np.array([f(mol) for k, f in Descriptors._descList], dtype='float64')
+    row[~(row <= 10 ** 35)] = np.nan
+    return name, act, row.astype('float32')
 
 
-def main(fname, ncpu, tautomers_smi=False, path=None):
+def main(fname, ncpu, tautomers_smi=False, path=None, out_format='csv', chunk_size=10000):
     if path is None:
         path = os.path.dirname(os.path.abspath(fname))
-    p = Pool(ncpu)
-    mols = read_input(fname)
     if tautomers_smi:
         max_tau = calc_max_tau(fname)
     else:
         max_tau = 0
-    pdres = pd.DataFrame()
-    for res in p.imap_unordered(_rdkit_2d, mols, chunksize=100):
-        pdres = pdres.append(res)
-    p.close()
-    p.join()
+    out_path = os.path.join(path, '2DDescrRDKit_{f_name}_{nconf}.csv'.format(f_name=os.path.basename(fname).split('.')[0],
+                                                                       nconf=max_tau))
+    columns = [k for k, f in Descriptors._descList]
+
+    # molecules are read lazily and computed chunk_size at a time (Pool.imap alone would queue the whole input),
+    # every chunk of rows is streamed to the descriptor store or kept for the csv frame
+    writer = None if out_format == 'csv' else StoreWriter(out_path, columns, dtype='float32')
+    mols = read_input(fname)
+    chunks, names, acts = [np.empty((0, len(columns)), dtype='float32')], [], []
+
+    with Pool(ncpu) as p:
+        for mol_chunk in iter(lambda: list(islice(mols, max(chunk_size, 1))), []):
+            x = np.empty((len(mol_chunk), len(columns)), dtype='float32')
+            chunk_names, chunk_acts = [], []
+            for i, (name, act, row) in enumerate(p.imap_unordered(_rdkit_2d, mol_chunk, chunksize=100)):
+                x[i] = row
+                chunk_names.append(name)
+                chunk_acts.append(act)
+            if writer is not None:
+                writer.append(x, chunk_names, chunk_names, chunk_acts)
+            else:
+                chunks.append(x)
+                names.extend(chunk_names)
+                acts.extend(chunk_acts)
+
+    if writer is not None:
+        out_path = writer.close(drop_nan=True)
+        nan_col = writer.nan_columns
+    else:
+        pdres = pd.DataFrame(np.concatenate(chunks), index=names, columns=columns)
+        pdres['mol_id'] = names
+        pdres['act'] = acts
+        pdres.index.name = 'mol_title'
+        nan_col = list(pdres.columns[pdres.isna().any().to_numpy()])
+        pdres = pdres.dropna(axis='columns')
+        out_path = write_frame(out_path, pdres, out_format=out_format)
 
-    pdres.index.name = 'mol_title'
     # clean
-    if pdres.isna().sum().sum() != 0:
+    if nan_col:
         print('Warning. Nan 2D descr columns', fname)
-        nan_col = list(pdres.columns[pdres.isna().sum().to_numpy().nonzero()])
         print('2D descr Nan columns = {}'.format(nan_col))
-        pdres = pdres.dropna( axis='columns')
-
-    out_path = os.path.join(path, '2DDescrRDKit_{f_name}_{nconf}.csv'.format(f_name=os.path.basename(fname).split('.')[0],
-                                                                       nconf=max_tau))
-    pdres.to_csv(out_path)
 
     return out_path
 
@@ -60,6 +81,11 @@ if __name__ == '__main__':
                         help='out path')
     parser.add_argument('-n', '--nc', metavar='num', required=False, default=2, type=int,
                         help='Num of cores for calculation')
+    parser.add_argument('-c', '--chunk_size', metavar='num', required=False, default=10000, type=int,
+                        help='Rows kept in memory before they are written to the npy store')
+
+    parser.add_argument('-f', '--format', metavar='csv|npy', default='csv', choices=['csv', 'npy'],
+                        help='output format: csv or npy descriptor store with a json sidecar')
 
     args = parser.parse_args()
 
@@ -67,4 +93,4 @@ if __name__ == '__main__':
     _path = args.path
     _nc = args.nc
 
-    main(fname=_in_fname, ncpu=_nc, path=_path)
+    main(fname=_in_fname, ncpu=_nc, path=_path, out_format=args.format, chunk_size=args.chunk_size)
@@ -4,6 +4,7 @@ import pandas as pd
 from multiprocessing import Pool
 from rdkit.Chem import Descriptors3D
 from .read_input import read_input
+from .descriptor_store import write_frame
 
 
 def _rdkit_3d(mol_tup):
@@ -34,7 +35,7 @@ def _rdkit_3d(mol_tup):
     return tmp
 
 
-def main(fname=None, ncpu=None, path=None, del_log=True):
+def main(fname=None, ncpu=None, path=None, del_log=True, out_format='csv'):
     if path is None:
         path = os.path.dirname(os.path.abspath(fname))
 
@@ -92,7 +93,7 @@ def main(fname=None, ncpu=None, path=None, del_log=True):
 
     out_fname = os.path.join(path, '3DDescrRDKit_{f_name}.csv'.format(f_name=os.path.basename(fname).split('.')[0]))
 
-    d3_data.to_csv(out_fname)
+    out_fname = write_frame(out_fname, d3_data, dtype='float32', out_format=out_format)
 
     return out_fname
 
@@ -111,9 +112,12 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--nc', metavar='num', required=False, default=2, type=int,
                         help='Num of cores for calculation')
 
+    parser.add_argument('-f', '--format', metavar='csv|npy', default='csv', choices=['csv', 'npy'],
+                        help='output format: csv or npy descriptor store with a json sidecar')
+
     args = parser.parse_args()
     _in_fname = args.input
     _path = args.path
     _nc = args.nc
 
-    main(fname=_in_fname, ncpu=_nc, path=_path)
+    main(fname=_in_fname, ncpu=_nc, path=_path, out_format=args.format)
@@ -1,48 +1,100 @@
 import os
 import argparse
+from itertools import islice
 import numpy as np
 import pandas as pd
-from rdkit import DataStructs
-from rdkit.Chem import AllChem
+from scipy import sparse
+from multiprocessing import Pool
+from rdkit.Chem import rdFingerprintGenerator
 from .read_input import read_input
 from .read_input import calc_max_tau
+from .descriptor_store import write_frame, write_store
 
-def rdkit_numpy_convert(fp):
-    output = []
-    for f in fp:
-        arr = np.zeros((1,))
-        DataStructs.ConvertToNumpyArray(f, arr)
-        output.append(arr)
-    return np.asarray(output)
+_generator = None
+_use_counts = False
 
 
-def main(fname, tautomers_smi=False, path=None):
+def _init_generator(radius, n_bits, use_chirality, use_counts):
+    global _generator, _use_counts
+    _generator = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=n_bits,
+                                                           includeChirality=use_chirality)
+    _use_counts = use_counts
+
+
+def _morgan_bits(mol):
+    # on-bit indices and their values (1 or counts)
+    if _use_counts:
+        fp = _generator.GetCountFingerprintAsNumPy(mol)
+    else:
+        fp = _generator.GetFingerprintAsNumPy(mol)
+    idx = np.flatnonzero(fp).astype(np.int32)
+    return idx, fp[idx]
+
+
+def main(fname, tautomers_smi=False, path=None, out_format='csv', radius=2, n_bits=2048, use_chirality=False,
+         use_counts=False, ncpu=1, chunk_size=10000):
+    """
+    out_format: csv, npy (dense uint8, uint16 for counts), bits (np.packbits rows, binary fingerprints only) or npz (CSR)
+    """
     if path is None:
         path = os.path.dirname(fname)
     if tautomers_smi:
         max_tau = calc_max_tau(fname)
     else:
         max_tau = 0
-    mol_id_gener = read_input(fname)
-    mol_id_list = [m for m in mol_id_gener]
+    if out_format == 'bits' and use_counts:
+        raise ValueError('Count fingerprints can not be bit-packed, use npy or npz')
+    out_path = os.path.join(path,
+                            'MorganFprRDKit_{f_name}_{nconf}.csv'.format(f_name=os.path.basename(fname).split('.')[0],
+                                                                         nconf=max_tau))
+
+    # molecules are read lazily and computed chunk_size at a time (Pool.imap alone would queue the whole input),
+    # names and activities are collected along with the rows
+    mols = read_input(fname)
+    width = (n_bits + 7) // 8 if out_format == 'bits' else n_bits
+    # counts are stored as uint16, a larger one is an error rather than a silently clipped value
+    dtype = np.uint16 if use_counts else np.uint8
+    name, act, blocks = [], [], [np.zeros((0, width), dtype=dtype)]
+    indptr, indices, values = [0], [], []
 
-    fp = [AllChem.GetMorganFingerprintAsBitVect(m[0], 2) for m in mol_id_list]
-    x = rdkit_numpy_convert(fp)
-    name = [m[1] for m in mol_id_list]
-    act = [m[2] for m in mol_id_list]
+    with Pool(ncpu, initializer=_init_generator, initargs=(radius, n_bits, use_chirality, use_counts)) as p:
+        for mol_chunk in iter(lambda: list(islice(mols, max(chunk_size, 1))), []):
+            name.extend(m[1] for m in mol_chunk)
+            act.extend(m[2] for m in mol_chunk)
+            if out_format != 'npz':
+                x = np.zeros((len(mol_chunk), width), dtype=dtype)
+                blocks.append(x)
+            fps = p.imap(_morgan_bits, (m[0] for m in mol_chunk), chunksize=1000)
+            for i, (idx, val) in enumerate(fps):
+                if len(val) and val.max() > np.iinfo(dtype).max:
+                    raise ValueError('Morgan count {} of {} does not fit {}'.format(val.max(), mol_chunk[i][1],
+                                                                                    np.dtype(dtype).name))
+                val = val.astype(dtype)
+                if out_format == 'bits':
+                    # bit i of the row lives in byte i // 8 at position 7 - i % 8, as in np.packbits
+                    np.bitwise_or.at(x[i], idx >> 3, (128 >> (idx & 7)).astype(np.uint8))
+                elif out_format == 'npz':
+                    indices.append(idx)
+                    values.append(val)
+                    indptr.append(indptr[-1] + len(idx))
+                else:
+                    x[i, idx] = val
+
+    columns = range(n_bits)
+    if out_format == 'npz':
+        x = sparse.csr_matrix((np.concatenate(values or [np.zeros(0, dtype)]),
+                               np.concatenate(indices or [np.zeros(0, np.int32)]), indptr),
+                              shape=(len(name), n_bits))
+        return write_store(out_path, x, columns, name, name, act)
+    x = np.concatenate(blocks)
+    if out_format in ('npy', 'bits'):
+        return write_store(out_path, x, columns, name, name, act, packed=out_format == 'bits')
 
     pdres = pd.DataFrame(x)
     pdres.loc[:, 'act'] = act
     pdres.loc[:, 'mol_id'] = name
     pdres.loc[:, 'mol_title'] = name
-
-    out_path = os.path.join(path,
-                            'MorganFprRDKit_{f_name}_{nconf}.csv'.format(f_name=os.path.basename(fname).split('.')[0],
-                                                                         nconf=max_tau))
-
-    pdres.to_csv(out_path, index=False)
-
-    return out_path
+    return write_frame(out_path, pdres, out_format=out_format, index=False)
 
 
 def calc_morgan_descriptors(*args, **kwargs):
@@ -56,8 +108,20 @@ if __name__ == '__main__':
                              'Without colname')
     parser.add_argument('-p', '--path', metavar='path', default=None, help='out path')
 
+    parser.add_argument('-f', '--format', metavar='csv|npy|bits|npz', default='csv', choices=['csv', 'npy', 'bits', 'npz'],
+                        help='output format: csv, dense npy store, bit-packed npy store or sparse npz store')
+    parser.add_argument('-r', '--radius', metavar='num', default=2, type=int, help='Morgan radius')
+    parser.add_argument('-b', '--nbits', metavar='num', default=2048, type=int, help='fingerprint size')
+    parser.add_argument('--chirality', action='store_true', default=False, help='include chirality')
+    parser.add_argument('--counts', action='store_true', default=False, help='count fingerprints instead of bits')
+    parser.add_argument('-n', '--nc', metavar='num', required=False, default=1, type=int,
+                        help='Num of cores for calculation')
+    parser.add_argument('-c', '--chunk_size', metavar='num', required=False, default=10000, type=int,
+                        help='Molecules read from the input at a time')
+
     args = parser.parse_args()
     _in_fname = args.input
     _path = args.path
 
-    main(fname=_in_fname, path=_path)
+    main(fname=_in_fname, path=_path, out_format=args.format, radius=args.radius, n_bits=args.nbits,
+         use_chirality=args.chirality, use_counts=args.counts, ncpu=args.nc, chunk_size=args.chunk_size)
@@ -1,57 +1,89 @@
 import os
+import json
 import argparse
 import pkg_resources
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from multiprocessing import Pool
 from rdkit.Chem import ChemicalFeatures
 from rdkit.Chem.Pharm2D import Generate
 from rdkit.Chem.Pharm2D.SigFactory import SigFactory
 from .read_input import read_input
 from .read_input import calc_max_tau
+from .descriptor_store import write_frame, write_store
 
 fdef_fname = pkg_resources.resource_filename(__name__, 'pmapper_backlog/smarts_features.fdef')
-featFactory = ChemicalFeatures.BuildFeatureFactory(fdef_fname)
-sigFactory = SigFactory(featFactory, minPointCount=2, maxPointCount=3, trianglePruneBins=False)
-sigFactory.SetBins([(0, 2), (2, 5), (5, 8)])
-sigFactory.Init()
+
+# SigFactory parameters, bins are (min, max) topological distance ranges
+SIG_FACTORY = {'fdef': fdef_fname, 'minPointCount': 2, 'maxPointCount': 3, 'trianglePruneBins': False,
+               'bins': [(0, 2), (2, 5), (5, 8)]}
+
+_sig_factory = None
+
+
+def build_sig_factory(fdef=fdef_fname, minPointCount=2, maxPointCount=3, trianglePruneBins=False,
+                      bins=((0, 2), (2, 5), (5, 8))):
+    feat_factory = ChemicalFeatures.BuildFeatureFactory(fdef)
+    sig_factory = SigFactory(feat_factory, minPointCount=minPointCount, maxPointCount=maxPointCount,
+                             trianglePruneBins=trianglePruneBins)
+    sig_factory.SetBins([tuple(b) for b in bins])
+    sig_factory.Init()
+    return sig_factory
+
+
+def _init_sig_factory(params):
+    # SigFactory can't be pickled, every worker builds its own from the parameters
+    global _sig_factory
+    _sig_factory = build_sig_factory(**params)
 
 
 def _ph_rdkit(mols_tup):
     mol, name, act, _ = mols_tup
-    ph = Generate.Gen2DFingerprint(mol, sigFactory)
-    tmp = pd.DataFrame(columns=range(ph.GetNumBits()))
-    ph_bits = list(ph.GetOnBits())
-    for n_bit in ph_bits:
-        tmp.loc[name, n_bit] = 1
-    tmp.loc[name, 'mol_id'] = name
-    tmp.loc[name, 'act'] = act
-    tmp = tmp.fillna(0)
-    return tmp
+    ph = Generate.Gen2DFingerprint(mol, _sig_factory)
+    return name, act, np.array(list(ph.GetOnBits()), dtype=np.int32)
 
 
-def main(fname, ncpu, tautomers_smi=False, path=None):
+def main(fname, ncpu, tautomers_smi=False, path=None, out_format='csv', sig_factory=None):
+    """
+    out_format: npz writes the on-bits as a CSR store, npy and csv densify them.
+    sig_factory: dict of build_sig_factory parameters updating SIG_FACTORY.
+    """
+    params = dict(SIG_FACTORY, **(sig_factory or {}))
+    n_bits = build_sig_factory(**params).GetSigSize()
 
-    p = Pool(ncpu)
     if path is None:
         path = os.path.dirname(os.path.abspath(fname))
     mols = read_input(fname)
-    pdres = pd.DataFrame()
     if tautomers_smi:
         max_tau = calc_max_tau(fname)
     else:
         max_tau = 0
-    for res in p.imap_unordered(_ph_rdkit, mols, chunksize=100):
-        pdres = pdres.append(res)
-    p.close()
-    p.join()
-    pdres.index.name = 'mol_title'
-    #  mol_id, act columns
-    lb = len(pdres.columns) - 2
+
+    names, acts, indptr, indices = [], [], [0], []
+    with Pool(ncpu, initializer=_init_sig_factory, initargs=(params,)) as p:
+        for name, act, bits in p.imap(_ph_rdkit, mols, chunksize=100):
+            names.append(name)
+            acts.append(act)
+            indices.append(bits)
+            indptr.append(indptr[-1] + len(bits))
+
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+    x = sparse.csr_matrix((np.ones(len(indices), dtype=np.uint8), indices, indptr), shape=(len(names), n_bits))
+
     out_path = os.path.join(path,
                             'PhFprRDKit_{f_name}_{nconf}.csv'.format(f_name=os.path.basename(fname).split('.')[0],
                                                                      nconf=max_tau))
-    pdres.to_csv(out_path)
-    return out_path
+    if out_format == 'npz':
+        return write_store(out_path, x, range(n_bits), names, names, acts)
+    if out_format == 'npy':
+        return write_store(out_path, x.toarray(), range(n_bits), names, names, acts)
+
+    pdres = pd.DataFrame(x.toarray(), index=names)
+    pdres['mol_id'] = names
+    pdres['act'] = acts
+    pdres.index.name = 'mol_title'
+    return write_frame(out_path, pdres, out_format=out_format)
 
 
 def calc_ph_descriptors(*args, **kwargs):
@@ -67,9 +99,15 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--nc', metavar='num', required=False, default=2, type=int,
                         help='Num of cores for calculation')
 
+    parser.add_argument('-f', '--format', metavar='csv|npy|npz', default='csv', choices=['csv', 'npy', 'npz'],
+                        help='output format: csv, dense npy store or sparse npz store')
+    parser.add_argument('-s', '--sig_factory', metavar='json', default=None,
+                        help='SigFactory parameters as json, e.g. \'{"maxPointCount": 2, "bins": [[0, 3], [3, 8]]}\'')
+
     args = parser.parse_args()
     _in_fname = args.input
     _path = args.path
     _nc = args.nc
+    _sig_params = json.loads(args.sig_factory) if args.sig_factory else None
 
-    main(fname=_in_fname, ncpu=_nc, path=_path)
+    main(fname=_in_fname, ncpu=_nc, path=_path, out_format=args.format, sig_factory=_sig_params)
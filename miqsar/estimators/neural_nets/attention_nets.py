@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from torch.nn import Sequential, Linear, Sigmoid, Softmax, Tanh
+import torch.nn.functional as F
 from torch.nn.functional import softmax
 from .base_nets import BaseRegressor, BaseClassifier, BaseNet
 from .mi_nets import MainNet
@@ -12,37 +13,49 @@ class WeightsDropout(nn.Module):
         super().__init__()
         self.p = p
 
-    def forward(self, w):
+    def forward(self, w, m=None):
         if self.p == 0:
             return w
-        d0 = [[i] for i in range(len(w))]
-        d1 = w.argsort(dim=2)[:, :, :int(w.shape[2] * self.p)]
-        d1 = [i.reshape(1, -1)[0].tolist() for i in d1]
-        #
-        w_new = w.clone()
-        w_new[d0, :, d1] = 0
-        #
-        d1 = [i[0].nonzero().flatten().tolist() for i in w_new]
-        w_new[d0, :, d1] = Softmax(dim=1)(w_new[d0, :, d1])
+        if m is None:
+            m = torch.ones_like(w)
+        else:
+            m = torch.transpose(m, 2, 1)
+        keep = m.bool()
+        # the int(n * p) smallest weights of every bag are dropped, padding is never counted
+        k = (keep.sum(dim=2, keepdim=True).double() * self.p).long()
+        order = w.masked_fill(~keep, float('inf')).argsort(dim=2)
+        drop = torch.arange(w.shape[2], device=w.device) < k
+        keep = keep & ~torch.zeros_like(keep).scatter(2, order, drop)
+
+        w_new = Softmax(dim=2)(w.masked_fill(~keep, float('-inf'))).nan_to_num(0)
         return w_new
 
 
 class SelfAttention(nn.Module):
-    def __init__(self, inp_dim, out_dim):
+    def __init__(self, inp_dim, out_dim, fused=True):
         super().__init__()
 
         self.w_query = nn.Linear(inp_dim, out_dim)
         self.w_key = nn.Linear(inp_dim, out_dim)
         self.w_value = nn.Linear(inp_dim, out_dim)
+        self.fused = fused and hasattr(F, 'scaled_dot_product_attention')
 
-    def forward(self, x):
+    def forward(self, x, m=None):
         keys = self.w_key(x)
         querys = self.w_query(x)
         values = self.w_value(x)
 
-        att_weights = softmax(querys @ torch.transpose(keys, 2, 1), dim=-1)
-        weighted_values = values[:, :, None] * torch.transpose(att_weights, 2, 1)[:, :, :, None]
-        outputs = weighted_values.sum(dim=1)
+        # padded instances are masked out as keys, batches without padding skip the mask
+        mask = None if m is None or m.all() else torch.transpose(m, 2, 1).bool()
+        if self.fused:
+            # the fused kernel scales by 1 / sqrt(d), queries are pre-scaled to keep the unscaled scores
+            # (the scale argument needs torch >= 2.1)
+            return F.scaled_dot_product_attention(querys * querys.shape[-1] ** 0.5, keys, values, attn_mask=mask)
+
+        att_weights = querys @ torch.transpose(keys, 2, 1)
+        if mask is not None:
+            att_weights = att_weights.masked_fill(~mask, float('-inf'))
+        outputs = softmax(att_weights, dim=-1) @ values
 
         return outputs
 
@@ -69,10 +82,10 @@ class AttentionNet(BaseNet):
 
     def forward(self, x, m):
         x = self.main_net(x)
-        x_det = torch.transpose(m * self.detector(x), 2, 1)
+        x_det = torch.transpose(self.detector(x).masked_fill(m == 0, float('-inf')), 2, 1)
 
         w = Softmax(dim=2)(x_det)
-        w = WeightsDropout(p=self.dropout)(w)
+        w = WeightsDropout(p=self.dropout)(w, m)
 
         x = torch.bmm(w, x)
         out = self.estimator(x)
@@ -137,7 +150,7 @@ class GlobalTempAttentionNet(BaseNet):
         temp = self.dropout.to(x.device)
 
         x = self.main_net(x)
-        x_det = torch.transpose(m * self.detector(x), 2, 1)
+        x_det = torch.transpose(self.detector(x).masked_fill(m == 0, float('-inf')), 2, 1)
 
         w = Softmax(dim=2)(x_det / temp)
 
@@ -182,7 +195,7 @@ class TempAttentionNet(BaseNet):
     def forward(self, x, m):
 
         x = self.main_net(x)
-        x_det = torch.transpose(m * self.detector(x), 2, 1)
+        x_det = torch.transpose(self.detector(x).masked_fill(m == 0, float('-inf')), 2, 1)
 
         w = Softmax(dim=2)(x_det / self.dropout)
 
@@ -218,7 +231,7 @@ class GumbelAttentionNet(BaseNet):
     def forward(self, x, m):
 
         x = self.main_net(x)
-        x_det = torch.transpose(m * self.detector(x), 2, 1)
+        x_det = torch.transpose(self.detector(x).masked_fill(m == 0, float('-inf')), 2, 1)
 
         w = nn.functional.gumbel_softmax(x_det, tau=self.dropout, dim=2)
 
@@ -246,12 +259,12 @@ class SelfAttentionNet(BaseNet):
 
     def forward(self, x, m):
         x = self.main_net(x)
-        x = self.self_attention(x)
+        x = self.self_attention(x, m)
 
-        x_det = torch.transpose(m * self.detector(x), 2, 1)
+        x_det = torch.transpose(self.detector(x).masked_fill(m == 0, float('-inf')), 2, 1)
 
         w = Softmax(dim=2)(x_det)
-        w = WeightsDropout(p=self.dropout)(w)
+        w = WeightsDropout(p=self.dropout)(w, m)
 
         x = torch.bmm(w, x)
         out = self.estimator(x)
@@ -282,9 +295,9 @@ class GatedAttentionNet(AttentionNet, BaseNet):
         w_v = self.attention_V(x)
         w_u = self.attention_U(x)
 
-        x_det = torch.transpose(m * self.detector(w_v * w_u), 2, 1)
+        x_det = torch.transpose(self.detector(w_v * w_u).masked_fill(m == 0, float('-inf')), 2, 1)
         w = Softmax(dim=2)(x_det)
-        w = WeightsDropout(p=self.dropout)(w)
+        w = WeightsDropout(p=self.dropout)(w, m)
 
         x = torch.bmm(w, x)
         out = self.estimator(x)
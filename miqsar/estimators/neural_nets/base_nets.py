@@ -5,7 +5,7 @@ import torch_optimizer as optim
 from torch.utils.data import DataLoader
 from torch.nn import Sigmoid
 from sklearn.model_selection import train_test_split
-from .utils import MBSplitter
+from .utils import MBSplitter, BucketBatchSampler, EarlyStopping, PackedBags, iter_chunks
 
 
 class EntropyRegularizer(nn.Module):
@@ -41,41 +41,28 @@ class BaseNet(nn.Module):
         return self.__class__.__name__
 
     def add_padding(self, x):
-        bag_size = max(len(i) for i in x)
-        mask = np.ones((len(x), bag_size, 1))
-
-        out = []
-        for i, bag in enumerate(x):
-            bag = np.asarray(bag)
-            if len(bag) < bag_size:
-                mask[i][len(bag):] = 0
-                padding = np.zeros((bag_size - bag.shape[0], bag.shape[1]))
-                bag = np.vstack((bag, padding))
-            out.append(bag)
-        out_bags = np.asarray(out)
-        return out_bags, mask
+        return PackedBags.from_bags(x).pad()
 
     def train_val_split(self, x, y, val_size=0.2, random_state=42):
-        x, y = np.asarray(x), np.asarray(y)
-        x, m = self.add_padding(x)
+        x, y = PackedBags.from_bags(x), np.asarray(y)
 
-        x_train, x_val, y_train, y_val, m_train, m_val = train_test_split(x, y, m, test_size=val_size,
-                                                                          random_state=random_state)
-        x_train, y_train, m_train = self.array_to_tensor(x_train, y_train, m_train)
-        x_val, y_val, m_val = self.array_to_tensor(x_val, y_val, m_val)
+        idx_train, idx_val = train_test_split(np.arange(len(x)), test_size=val_size, random_state=random_state)
+        x_train, x_val = x.subset(idx_train), x.subset(idx_val)
+        y_train, y_val = y[idx_train], y[idx_val]
 
-        return x_train, x_val, y_train, y_val, m_train, m_val
+        return x_train, x_val, y_train, y_val
 
-    def get_mini_batches(self, x, y, m, batch_size=16):
-        data = MBSplitter(x, y, m)
-        mb = DataLoader(data, batch_size=batch_size, shuffle=True)
+    def get_mini_batches(self, x, y, batch_size=16, n_buckets=1, shuffle=True):
+        data = MBSplitter(x, y)
+        sampler = BucketBatchSampler(x, batch_size=batch_size, n_buckets=n_buckets, shuffle=shuffle)
+        mb = DataLoader(data, sampler=sampler, batch_size=None, collate_fn=lambda i: self.array_to_tensor(*i))
         return mb
 
     def array_to_tensor(self, x, y, m):
 
-        x = torch.from_numpy(x.astype('float32'))
+        x = torch.from_numpy(x.astype('float32', copy=False))
         y = torch.from_numpy(y.astype('float32'))
-        m = torch.from_numpy(m.astype('float32'))
+        m = torch.from_numpy(m.astype('float32', copy=False))
         if y.ndim == 1:
             y = y.reshape(-1, 1)
         if self.init_cuda:
@@ -98,54 +85,77 @@ class BaseNet(nn.Module):
         out = out.view(-1, 1)
         return None, out
 
-    def fit(self, x, y, n_epoch=100, batch_size=128, lr=0.001, weight_decay=0, dropout=0, verbose=False):
+    def fit(self, x, y, n_epoch=100, batch_size=128, lr=0.001, weight_decay=0, dropout=0, n_buckets=1,
+            patience=None, verbose=False):
         self.dropout = dropout
 
-        x_train, x_val, y_train, y_val, m_train, m_val = self.train_val_split(x, y)
+        x_train, x_val, y_train, y_val = self.train_val_split(x, y)
         optimizer = optim.Yogi(self.parameters(), lr=lr, weight_decay=weight_decay)
 
-        val_loss = []
+        mb = self.get_mini_batches(x_train, y_train, batch_size=batch_size, n_buckets=n_buckets)
+        mb_val = self.get_mini_batches(x_val, y_val, batch_size=batch_size, n_buckets=None, shuffle=False)
+
+        early_stopping = EarlyStopping(patience=patience)
         for epoch in range(n_epoch):
-            mb = self.get_mini_batches(x_train, y_train, m_train, batch_size=batch_size)
             self.train()
             for x_mb, y_mb, m_mb in mb:
                 loss = self.loss_batch(x_mb, y_mb, m_mb, optimizer=optimizer)
 
             self.eval()
             with torch.no_grad():
-                loss = self.loss_batch(x_val, y_val, m_val, optimizer=None)
-                val_loss.append(loss)
-
-            min_loss_idx = val_loss.index(min(val_loss))
-            if min_loss_idx == epoch:
-                best_parameters = self.state_dict()
-                if verbose:
-                    print(epoch, loss)
-        self.load_state_dict(best_parameters, strict=True)
+                losses, sizes = [], []
+                for x_mb, y_mb, m_mb in mb_val:
+                    losses.append(self.loss_batch(x_mb, y_mb, m_mb, optimizer=None))
+                    sizes.append(len(y_mb))
+                loss = np.average(losses, weights=sizes)
+
+            early_stopping.step(loss, self)
+            if early_stopping.improved and verbose:
+                print(epoch, loss)
+            if early_stopping.stop:
+                break
+        self.padding_waste = mb.sampler.padding_waste
+        if verbose:
+            print('padding waste', self.padding_waste)
+        early_stopping.restore(self)
         return self
 
-    def predict(self, x):
-        x, m = self.add_padding(np.asarray(x))
-        x = torch.from_numpy(x.astype('float32'))
-        m = torch.from_numpy(m.astype('float32'))
-        self.eval()
-        with torch.no_grad():
-            if self.init_cuda:
-                x, m = x.cuda(), m.cuda()
-            w, y_pred = self.forward(x, m)
-        return np.asarray(y_pred.cpu())
-
-    def get_instance_weights(self, x):
-        x, m = self.add_padding(np.asarray(x))
-        x = torch.from_numpy(x.astype('float32'))
-        m = torch.from_numpy(m.astype('float32'))
+    def forward_batches(self, x, batch_size=128):
+        # bags of equal size are batched together, so no padding is computed at all;
+        # batches come out in the order of np.concatenate(x.buckets())
+        mb = self.get_mini_batches(x, np.zeros(len(x)), batch_size=batch_size, n_buckets=None, shuffle=False)
         self.eval()
         with torch.no_grad():
-            if self.init_cuda:
-                x, m = x.cuda(), m.cuda()
-            w, y_pred = self.forward(x, m)
-        w = w.view(w.shape[0], w.shape[-1]).cpu()
-        w = [np.asarray(i[j.bool().flatten()]) for i, j in zip(w, m)]
+            for x_mb, _, m_mb in mb:
+                w, y_pred = self.forward(x_mb, m_mb)
+                yield w, y_pred, m_mb
+
+    def forward_bags(self, x, batch_size=128, weights=False):
+        x = PackedBags.from_bags(x)
+        order = np.concatenate(x.buckets())
+
+        y_out, w_out = np.empty((len(x), 1), dtype='float32'), [None] * len(x)
+        start = 0
+        for w, y_pred, m in self.forward_batches(x, batch_size=batch_size):
+            idx = order[start:start + len(y_pred)]
+            start += len(y_pred)
+            y_out[idx] = np.asarray(y_pred.cpu()).reshape(-1, 1)
+            if weights:
+                w = w.view(w.shape[0], w.shape[-1]).cpu()
+                for i, w_i, m_i in zip(idx, w, m.cpu()):
+                    w_out[i] = np.asarray(w_i[m_i.bool().flatten()])
+        return y_out, w_out
+
+    def predict(self, x, batch_size=128):
+        y_pred, _ = self.forward_bags(x, batch_size=batch_size)
+        return y_pred
+
+    def get_instance_weights(self, x, batch_size=128):
+        _, w = self.forward_bags(x, batch_size=batch_size, weights=True)
         return w
 
-
+    def predict_iter(self, x, chunk_size=1024, batch_size=128, weights=False):
+        # x can be any iterable of bags, only chunk_size bags are held in memory at a time
+        for chunk in iter_chunks(x, chunk_size):
+            y_pred, w = self.forward_bags(chunk, batch_size=batch_size, weights=weights)
+            yield (y_pred, w) if weights else y_pred
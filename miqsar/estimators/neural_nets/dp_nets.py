@@ -6,7 +6,6 @@ from torch.nn import Softmax
 from miqsar.estimators.neural_nets.base_nets import BaseRegressor, BaseClassifier, BaseNet, EntropyRegularizer
 from .mi_nets import MainNet
 from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import train_test_split
 
 
 class MarginLoss(nn.Module):
@@ -45,7 +44,7 @@ class DynamicPooling(nn.Module):
         x = m * x
         b = torch.zeros(x.shape[0], x.shape[1], 1).to(x.device)
         for t in range(self.n_iter):
-            w = Softmax(dim=1)(m * b)
+            w = Softmax(dim=1)(b.masked_fill(m == 0, float('-inf')))
             w = torch.transpose(w, 2, 1)
             sigma = torch.bmm(w, x)
             s = Squash()(sigma)
@@ -53,7 +52,7 @@ class DynamicPooling(nn.Module):
             b_new = torch.sum(s * x, dim=2)
             b_new = b_new.reshape(b_new.shape[0], b_new.shape[1], 1)
             b = b + b_new
-        w = Softmax(dim=1)(b)
+        w = Softmax(dim=1)(b.masked_fill(m == 0, float('-inf')))
 
         s = s.view(s.shape[0], s.shape[-1])
         w = w.view(w.shape[0], w.shape[1])
@@ -79,11 +78,11 @@ class DPNet(BaseNet):
         out = self.estimator(s)
         return w, out
 
-    def predict(self, x):
-        y_pred = super().predict(x)
+    def forward_bags(self, x, batch_size=128, weights=False):
+        y_pred, w = super().forward_bags(x, batch_size=batch_size, weights=weights)
         if isinstance(self, BaseRegressor):
             y_pred = self.scaler.inverse_transform(y_pred.reshape(-1, 1)).flatten()
-        return y_pred
+        return y_pred, w
 
 
 class DPNetRegressor(DPNet, BaseRegressor):
@@ -91,18 +90,12 @@ class DPNetRegressor(DPNet, BaseRegressor):
         super().__init__(ndim=ndim, init_cuda=init_cuda)
 
     def train_val_split(self, x, y, val_size=0.2, random_state=42):
-        x, y = np.asarray(x), np.asarray(y)
-        x, m = self.add_padding(x)
-        x_train, x_val, y_train, y_val, m_train, m_val = train_test_split(x, y, m, test_size=val_size,
-                                                                          random_state=random_state)
+        x_train, x_val, y_train, y_val = super().train_val_split(x, y, val_size=val_size, random_state=random_state)
         if isinstance(self, BaseRegressor):
             self.scaler = MinMaxScaler()
             y_train = self.scaler.fit_transform(y_train.reshape(-1, 1)).flatten()
             y_val = self.scaler.transform(y_val.reshape(-1, 1)).flatten()
-
-        x_train, y_train, m_train = self.array_to_tensor(x_train, y_train, m_train)
-        x_val, y_val, m_val = self.array_to_tensor(x_val, y_val, m_val)
-        return x_train, x_val, y_train, y_val, m_train, m_val
+        return x_train, x_val, y_train, y_val
 
 
 class DPNetClassifier(DPNet, BaseClassifier):
@@ -21,13 +21,12 @@ class Pooling(nn.Module):
         self.pool = pool
 
     def forward(self, x, m):
-        x = m * x
         if self.pool == 'mean':
-            out = x.sum(axis=1) / m.sum(axis=1)
+            out = (m * x).sum(axis=1) / m.sum(axis=1)
         elif self.pool == 'max':
-            out = x.max(dim=1)[0]
+            out = x.masked_fill(m == 0, float('-inf')).max(dim=1)[0]
         elif self.pool == 'lse':
-            out = x.exp().sum(dim=1).log()
+            out = x.masked_fill(m == 0, float('-inf')).logsumexp(dim=1)
         return out
 
     def extra_repr(self):
@@ -76,7 +75,7 @@ class miNet(BaseNet):
         out = self.main_net(x)
         if isinstance(self, BaseClassifier):
             out = Sigmoid()(out)
-        w = Softmax(dim=1)(m * out)
+        w = Softmax(dim=1)(out.masked_fill(m == 0, float('-inf')))
         w = w.view(w.shape[0], w.shape[-1], w.shape[1])
         out = self.pooling(out, m)
         return w, out
@@ -7,6 +7,7 @@ from torch.nn import Sigmoid, Sequential, Linear, ReLU
 from torch.utils.data import Dataset
 from sklearn.model_selection import train_test_split
 from .mi_nets import MainNet
+from .utils import EarlyStopping, PackedBags, iter_chunks
 
 
 class MBSplitter(Dataset):
@@ -85,12 +86,13 @@ class MLP(nn.Module):
             out = Sigmoid()(out)
         return out
 
-    def fit(self, x, y, n_epoch=100, batch_size=128, lr=0.001, weight_decay=0, dropout=0, verbose=False):
+    def fit(self, x, y, n_epoch=100, batch_size=128, lr=0.001, weight_decay=0, dropout=0, patience=None,
+            verbose=False):
 
         x_train, x_val, y_train, y_val = self.train_val_split(x, y)
         optimizer = optim.Yogi(self.parameters(), lr=lr, weight_decay=weight_decay)
 
-        val_loss = []
+        early_stopping = EarlyStopping(patience=patience)
         for epoch in range(n_epoch):
             mb = self.get_mini_batches(x_train, y_train, batch_size=batch_size)
             self.train()
@@ -100,24 +102,29 @@ class MLP(nn.Module):
             self.eval()
             with torch.no_grad():
                 loss = self.loss_batch(x_val, y_val, optimizer=None)
-                val_loss.append(loss)
-
-            min_loss_idx = val_loss.index(min(val_loss))
-            if min_loss_idx == epoch:
-                best_parameters = self.state_dict()
-                if verbose:
-                    print(epoch, loss)
-        self.load_state_dict(best_parameters, strict=True)
+
+            early_stopping.step(loss, self)
+            if early_stopping.improved and verbose:
+                print(epoch, loss)
+            if early_stopping.stop:
+                break
+        early_stopping.restore(self)
         return self
 
-    def predict(self, x):
-        x = torch.from_numpy(x.astype('float32'))
+    def predict(self, x, batch_size=1024):
         self.eval()
+        y_pred = []
         with torch.no_grad():
-            if self.init_cuda:
-                x = x.cuda()
-            y_pred = self.forward(x)
-        return np.asarray(y_pred.cpu())
+            for i in range(0, len(x), batch_size):
+                x_mb = torch.from_numpy(np.asarray(x[i:i + batch_size], dtype='float32'))
+                if self.init_cuda:
+                    x_mb = x_mb.cuda()
+                y_pred.append(np.asarray(self.forward(x_mb).cpu()))
+        return np.concatenate(y_pred)
+
+    def predict_iter(self, x, chunk_size=1024):
+        for chunk in iter_chunks(x, chunk_size):
+            yield self.predict(np.asarray(chunk), batch_size=chunk_size)
 
 
 class MLPNetClassifier(MLP, BaseClassifier):
@@ -139,22 +146,25 @@ class MIWrapper:
         self.pool = pool
 
     def apply_pool(self, bags):
+        bags = PackedBags.from_bags(bags)
+        starts = bags.offsets[:-1]
         if self.pool == 'mean':
-            bags_modified = np.asarray([np.mean(bag, axis=0) for bag in bags])
+            bags_modified = np.add.reduceat(bags.instances, starts, axis=0) / bags.sizes.reshape(-1, 1)
         elif self.pool == 'extreme':
-            bags_max = np.asarray([np.amax(bag, axis=0) for bag in bags])
-            bags_min = np.asarray([np.amin(bag, axis=0) for bag in bags])
+            bags_max = np.maximum.reduceat(bags.instances, starts, axis=0)
+            bags_min = np.minimum.reduceat(bags.instances, starts, axis=0)
             bags_modified = np.concatenate((bags_max, bags_min), axis=1)
         elif self.pool == 'max':
-            bags_modified = np.asarray([np.amax(bag, axis=0) for bag in bags])
+            bags_modified = np.maximum.reduceat(bags.instances, starts, axis=0)
         elif self.pool == 'min':
-            bags_modified = np.asarray([np.amin(bag, axis=0) for bag in bags])
+            bags_modified = np.minimum.reduceat(bags.instances, starts, axis=0)
         return bags_modified
 
-    def fit(self, bags, labels, n_epoch=100, batch_size=128, weight_decay=0, dropout=0, temp=1, lr=0.001):
+    def fit(self, bags, labels, n_epoch=100, batch_size=128, weight_decay=0, dropout=0, temp=1, lr=0.001,
+            patience=None):
         bags_modified = self.apply_pool(bags)
         self.estimator.fit(bags_modified, labels, n_epoch=n_epoch, batch_size=batch_size,
-                           dropout=dropout, weight_decay=weight_decay, lr=lr)
+                           dropout=dropout, weight_decay=weight_decay, lr=lr, patience=patience)
         return self.estimator
 
     def predict(self, bags):
@@ -162,6 +172,10 @@ class MIWrapper:
         preds = self.estimator.predict(bags_modified).flatten()
         return preds
 
+    def predict_iter(self, bags, chunk_size=1024):
+        for chunk in iter_chunks(bags, chunk_size):
+            yield self.predict(chunk)
+
     def name(self):
         return '{}{}'.format(self.__class__.__name__, self.pool.capitalize())
 
@@ -183,18 +197,22 @@ class miWrapper:
             print('No exist')
         return preds
 
-    def fit(self, bags, labels, n_epoch=100, batch_size=128, dropout=0, weight_decay=0, lr=0.001):
-        bags = np.asarray(bags)
-        bags_modified = np.vstack(bags)
-        labels_modified = np.hstack([float(lb) * np.array(np.ones(len(bag))) for bag, lb in zip(bags, labels)])
+    def fit(self, bags, labels, n_epoch=100, batch_size=128, dropout=0, weight_decay=0, lr=0.001, patience=None):
+        bags = PackedBags.from_bags(bags)
+        bags_modified = bags.instances
+        labels_modified = np.repeat(np.asarray(labels, dtype=float), bags.sizes)
         self.estimator.fit(bags_modified, labels_modified, n_epoch=n_epoch, batch_size=batch_size,
-                           dropout=dropout, weight_decay=weight_decay, lr=lr)
+                           dropout=dropout, weight_decay=weight_decay, lr=lr, patience=patience)
         return self.estimator
 
     def predict(self, bags):
         preds = [self.apply_pool(self.estimator.predict(bag.reshape(-1, bag.shape[-1]))) for bag in bags]
         return np.asarray(preds)
 
+    def predict_iter(self, bags, chunk_size=1024):
+        for chunk in iter_chunks(bags, chunk_size):
+            yield self.predict(chunk)
+
     def name(self):
         return '{}{}'.format(self.__class__.__name__, self.pool.capitalize())
 
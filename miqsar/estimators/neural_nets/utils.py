@@ -1,7 +1,9 @@
 import torch
+import numpy as np
+from itertools import islice
 import torch.nn.functional as F
 from torch import nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 
 def set_seed(seed):
@@ -9,15 +11,174 @@ def set_seed(seed):
     torch.backends.cudnn.deterministic = True
 
 
+def iter_chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+class EarlyStopping:
+    """
+    Tracks the best validation loss and keeps a detached copy of the
+    corresponding parameters. The copy is allocated on the first
+    improvement and overwritten in place on later ones.
+    """
+
+    def __init__(self, patience=None):
+        self.patience = patience
+        self.best_loss = float('inf')
+        self.best_epoch = -1
+        self.best_state = None
+        self.epoch = -1
+
+    def step(self, loss, model):
+        self.epoch += 1
+        if loss < self.best_loss:
+            self.best_loss, self.best_epoch = loss, self.epoch
+            if self.best_state is None:
+                self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            else:
+                for k, v in model.state_dict().items():
+                    self.best_state[k].copy_(v)
+        return self.stop
+
+    @property
+    def improved(self):
+        return self.best_epoch == self.epoch
+
+    @property
+    def stop(self):
+        return self.patience is not None and self.epoch - self.best_epoch >= self.patience
+
+    def restore(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state, strict=True)
+        return model
+
+
+class PackedBags:
+    """
+    Bags of instances stored as one flat instance matrix and bag offsets.
+    Bag i is instances[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, instances, offsets):
+        self.instances = instances
+        self.offsets = offsets
+
+    @classmethod
+    def from_bags(cls, bags, dtype='float32'):
+        if isinstance(bags, cls):
+            return bags
+        bags = [np.atleast_2d(np.asarray(bag, dtype=dtype)) for bag in bags]
+        offsets = np.zeros(len(bags) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(bag) for bag in bags])
+        return cls(np.vstack(bags), offsets)
+
+    @property
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    @property
+    def n_dim(self):
+        return self.instances.shape[1]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return self.instances[self.offsets[i]:self.offsets[i + 1]]
+        return self.subset(np.arange(len(self))[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _rows(self, idx):
+        sizes = self.sizes[idx]
+        starts = self.offsets[:-1][idx]
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        rows = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], sizes)
+        return rows, sizes, offsets
+
+    def subset(self, idx):
+        rows, _, offsets = self._rows(np.asarray(idx, dtype=np.int64))
+        return PackedBags(self.instances[rows], offsets)
+
+    def pad(self, idx=None):
+        if idx is None:
+            idx = np.arange(len(self))
+        rows, sizes, offsets = self._rows(np.asarray(idx, dtype=np.int64))
+        bag_ids = np.repeat(np.arange(len(sizes)), sizes)
+        positions = np.arange(len(rows)) - offsets[:-1][bag_ids]
+
+        bag_size = sizes.max() if len(sizes) else 0
+        x = np.zeros((len(sizes), bag_size, self.n_dim), dtype=self.instances.dtype)
+        m = np.zeros((len(sizes), bag_size, 1), dtype=self.instances.dtype)
+        x[bag_ids, positions] = self.instances[rows]
+        m[bag_ids, positions] = 1
+        return x, m
+
+    def buckets(self, n_buckets=1):
+        # n_buckets=None gives one bucket per distinct bag size
+        order = np.argsort(self.sizes, kind='stable')
+        if n_buckets is None:
+            return np.split(order, np.flatnonzero(np.diff(self.sizes[order])) + 1)
+        return [i for i in np.array_split(order, max(1, min(n_buckets, len(order)))) if len(i)]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Yields index batches that never cross a bag size bucket, so every
+    batch is padded only to the largest bag it contains.
+    """
+
+    def __init__(self, bags, batch_size=128, n_buckets=1, shuffle=True):
+        self.sizes = bags.sizes
+        self.buckets = bags.buckets(n_buckets)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n_padded = 0
+        self.n_cells = 0
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket)).numpy()]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+
+        self.n_padded, self.n_cells = 0, 0
+        for batch in batches:
+            sizes = self.sizes[batch]
+            self.n_cells += sizes.max() * len(sizes)
+            self.n_padded += sizes.max() * len(sizes) - sizes.sum()
+            yield batch
+
+    def __len__(self):
+        return sum(-(-len(bucket) // self.batch_size) for bucket in self.buckets)
+
+    @property
+    def padding_waste(self):
+        # share of padded instance slots in the batches of the last pass
+        return self.n_padded / self.n_cells if self.n_cells else 0.
+
+
 class MBSplitter(Dataset):
-    def __init__(self, x, y, m):
+    def __init__(self, x, y):
         super(MBSplitter, self).__init__()
         self.x = x
         self.y = y
-        self.m = m
 
-    def __getitem__(self, i):
-        return self.x[i], self.y[i], self.m[i]
+    def __getitem__(self, idx):
+        x, m = self.x.pad(idx)
+        return x, self.y[idx], m
 
     def __len__(self):
         return len(self.y)
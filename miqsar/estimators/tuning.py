@@ -0,0 +1,119 @@
+import os
+import json
+import math
+import torch
+from multiprocessing import Pool
+
+
+def _init_worker(n_threads, initializer, initargs):
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_trial(task):
+    func, group, key, params, n_epoch = task
+    return group, key, n_epoch, float(func(params, n_epoch))
+
+
+class Tuner:
+    """
+    Successive halving over training epochs: all trials of a group are trained for
+    the smallest budget and the best 1/eta of each group go on to an eta times larger
+    one, up to n_epoch. min_epoch=None trains every trial for n_epoch.
+
+    func(params, n_epoch) -> score (higher is better) must be a module level function;
+    data is handed to the workers once through initializer/initargs. Scores are
+    appended to log_file as they arrive and logged trials are not trained again.
+    Daemonic processes can't start a Pool, use n_jobs=1 inside them.
+    """
+
+    def __init__(self, func, n_epoch=500, min_epoch=None, eta=3, n_jobs=1, n_threads=None,
+                 initializer=None, initargs=()):
+        self.func = func
+        self.n_epoch = n_epoch
+        self.min_epoch = min_epoch
+        self.eta = eta
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads
+        self.initializer = initializer
+        self.initargs = initargs
+
+    def budgets(self):
+        budgets = [self.n_epoch]
+        if self.min_epoch is not None:
+            while budgets[0] // self.eta >= self.min_epoch:
+                budgets.insert(0, budgets[0] // self.eta)
+        return budgets
+
+    def load_log(self, log_file):
+        scores = {}
+        if log_file is not None and os.path.exists(log_file):
+            with open(log_file) as f:
+                for line in f:
+                    if line.strip():
+                        rec = json.loads(line)
+                        scores[(rec['group'], rec['key'], rec['n_epoch'])] = rec['score']
+        return scores
+
+    def run(self, trials, log_file=None):
+        """
+        trials: list of (group, key, params), key is a json serializable trial id.
+        Returns {group: [(key, score, n_epoch), ...]} with the score at the last budget each trial reached.
+        """
+        scores = self.load_log(log_file)
+        log = open(log_file, 'a') if log_file is not None else None
+
+        if self.n_jobs > 1:
+            pool = Pool(self.n_jobs, initializer=_init_worker,
+                        initargs=(self.n_threads, self.initializer, self.initargs))
+            imap = pool.imap_unordered
+        else:
+            if self.initializer is not None:
+                self.initializer(*self.initargs)
+            pool, imap = None, map
+
+        results = {}
+        alive = list(trials)
+        try:
+            for n, n_epoch in enumerate(self.budgets()):
+                tasks = [(self.func, group, key, params, n_epoch) for group, key, params in alive
+                         if (group, key, n_epoch) not in scores]
+                for group, key, n_epoch_done, score in imap(_run_trial, tasks):
+                    scores[(group, key, n_epoch_done)] = score
+                    if log is not None:
+                        log.write(json.dumps({'group': group, 'key': key, 'n_epoch': n_epoch_done,
+                                              'score': score}) + '\n')
+                        log.flush()
+
+                rung = {}
+                for group, key, params in alive:
+                    results[(group, key)] = scores[(group, key, n_epoch)], n_epoch
+                    rung.setdefault(group, []).append((group, key, params))
+                if n == len(self.budgets()) - 1:
+                    break
+
+                alive = []
+                for group, group_trials in rung.items():
+                    group_trials.sort(key=lambda t: self.rank_score(scores[(t[0], t[1], n_epoch)]), reverse=True)
+                    alive.extend(group_trials[:math.ceil(len(group_trials) / self.eta)])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if log is not None:
+                log.close()
+
+        out = {}
+        for group, key, params in trials:
+            score, n_epoch = results[(group, key)]
+            out.setdefault(group, []).append((key, score, n_epoch))
+        return out
+
+    @staticmethod
+    def rank_score(score):
+        return -math.inf if score is None or math.isnan(score) else score
+
+    def best(self, results):
+        return {group: max(res, key=lambda r: (r[2], self.rank_score(r[1])))[0] for group, res in results.items()}
@@ -4,27 +4,27 @@ sys.path.append('/home/zankov/dev/miqsar')
 import os
 import shutil
 from multiprocessing import Pool
-from sklearn.model_selection import train_test_split
-from utils import DataReader, ModelBuilder, scale_data
+from utils import DataReader, ModelBuilder, scale_data, train_test_split_bags
 
 RANDOM_STATE = 45
 DATA_DIR = 'descriptors'
 OUT_DIR = 'models'
+RESUME = False  # keep OUT_DIR and skip the tuning trials already logged there
+N_JOBS = 1  # tuning trials trained in parallel, datasets then run one by one
+N_THREADS = None  # torch threads of every trial process, None keeps the torch default
 
-if os.path.exists(OUT_DIR):
+if os.path.exists(OUT_DIR) and not RESUME:
    shutil.rmtree(OUT_DIR)
-   os.mkdir(OUT_DIR)
-else:
-   os.mkdir(OUT_DIR)
+os.makedirs(OUT_DIR, exist_ok=True)
 
 def run(dataset):
-    os.mkdir(os.path.join(OUT_DIR, dataset))
+    os.makedirs(os.path.join(OUT_DIR, dataset), exist_ok=True)
 
     # 2d tune and build
     for alg in ['mil']:
-        data = DataReader(DATA_DIR, dataset).read_data(DATA_DIR)
+        data = DataReader(DATA_DIR, dataset, verbose=True).read_data(DATA_DIR)
 
-        model_builder = ModelBuilder(init_cuda=False)
+        model_builder = ModelBuilder(init_cuda=False, n_jobs=N_JOBS, n_threads=N_THREADS)
         with open('enzyme_list.txt', 'r') as f:
             enz_list = f.read().split(',')
         if dataset in enz_list:
@@ -37,16 +37,16 @@ def run(dataset):
                 continue
             CONF_DIR = '{}_{}'.format(dsc, alg)
             CONF_DIR = os.path.join(OUT_DIR, dataset, CONF_DIR)
-            os.mkdir(CONF_DIR)
+            os.makedirs(CONF_DIR, exist_ok=True)
             model_builder.local_dir = CONF_DIR
             #
             bags, labels, idx = data['dsc'][alg][dsc], data['labels'], data['idx']
-            x_train, x_test, y_train, y_test, idx_train, idx_test = train_test_split(bags, labels, idx,
-                                                                                             test_size=0.2,
-                                                                                             random_state=RANDOM_STATE)
-            x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split(x_train, y_train, idx_train,
-                                                                                          test_size=0.25,
-                                                                                          random_state=RANDOM_STATE)
+            x_train, x_test, y_train, y_test, idx_train, idx_test = train_test_split_bags(bags, labels, idx,
+                                                                                                  test_size=0.2,
+                                                                                                  random_state=RANDOM_STATE)
+            x_train, x_val, y_train, y_val, idx_train, idx_val = train_test_split_bags(x_train, y_train, idx_train,
+                                                                                               test_size=0.25,
+                                                                                               random_state=RANDOM_STATE)
             _, x_test = scale_data(x_train, x_test)
             x_train, x_val = scale_data(x_train, x_val)
             #
@@ -61,5 +61,10 @@ def run(dataset):
 
 datasets = os.listdir(DATA_DIR)
 if __name__ == '__main__':
-    with Pool(len(datasets)) as p:
-        p.map(run, datasets, chunksize=1)
+    # daemonic Pool workers can't start the Pool of the tuner
+    if N_JOBS > 1:
+        for dataset in datasets:
+            run(dataset)
+    else:
+        with Pool(len(datasets)) as p:
+            p.map(run, datasets, chunksize=1)
@@ -2,9 +2,11 @@ import sys
 sys.path.append('/home/zankov/dev/miqsar')
 
 import os
+import time
 import torch
 import numpy as np
 import pandas as pd
+from scipy import sparse
 
 from miqsar.estimators.neural_nets.base_nets import BaseClassifier
 from miqsar.estimators.neural_nets.mlp_nets import MIWrapperMLPClassifier, MIWrapperMLPRegressor
@@ -14,9 +16,13 @@ from miqsar.estimators.neural_nets.attention_nets import (AttentionNetClassifier
 from miqsar.estimators.neural_nets.attention_nets import GatedAttentionNetClassifier, GatedAttentionNetRegressor
 from miqsar.estimators.neural_nets.mi_nets import MINetClassifier, MINetRegressor
 from miqsar.estimators.neural_nets.mi_nets import miNetClassifier, miNetRegressor
-from miqsar.estimators.neural_nets.utils import set_seed
+from miqsar.estimators.neural_nets.utils import set_seed, PackedBags
+from miqsar.estimators.tuning import Tuner
+from miqsar.descriptor_calculation.descriptor_store import (store_name, store_exists, read_meta, read_store,
+                                                              read_descriptors)
 from sklearn.metrics import confusion_matrix
 from sklearn.preprocessing import MinMaxScaler
+from sklearn.model_selection import train_test_split
 from collections import defaultdict
 from sklearn.metrics import (r2_score, mean_squared_error, accuracy_score, balanced_accuracy_score,
                              average_precision_score,
@@ -24,41 +30,59 @@ from sklearn.metrics import (r2_score, mean_squared_error, accuracy_score, balan
 
 
 class DataReader:
-    def __init__(self, dsc_dir, dataset):
+    def __init__(self, dsc_dir, dataset, verbose=False):
         self.data = {'dsc': dict(), 'labels': dict(), 'idx': dict()}
         self.dataset = dataset
+        self.verbose = verbose
+        self.load_time = {}
         file = os.path.join(dsc_dir, dataset, '2DDescrRDKit_{}_0.csv'.format(self.dataset))
         self.mol_id = self.get_mol_id(file)
         _, self.data['labels'], self.data['idx'] = self.load_data(file, self.mol_id)
 
     def get_mol_id(self, fname):
-        data = pd.read_csv(fname, index_col='mol_id')
-        data.index = [i.upper() for i in data.index]
-        data = data.sort_index()
-        return data.index
-
-    def load_data(self, fname, mol_id):
-        data = pd.read_csv(fname, index_col='mol_id')
-        data.index = [i.split('__')[0] for i in data.index]
-        data = data.sort_index()
-
-        # train
-        idx, bags, labels = [], [], []
-        for i in mol_id:
-            if i in data.index.unique():
-                bag = data.loc[i:i].drop(['mol_title', 'act'], axis=1).values
-                label = float(data.loc[i:i]['act'].unique()[0])
-
-                bags.append(bag)
-                labels.append(label)
-                idx.append(i)
-            else:
-                bags.append(bag)
-                labels.append(label)
-                idx.append(i)
-
-        bags = np.array(bags)
-        labels = np.array(labels)
+        if store_exists(fname):
+            mol_id = read_meta(fname)['mol_id']
+        else:
+            mol_id = pd.read_csv(fname, usecols=['mol_id'])['mol_id']
+        return pd.Index(sorted(i.upper() for i in mol_id))
+
+    def read_table(self, fname, columns=None):
+        # the descriptor store if there is one next to fname, the csv otherwise
+        if store_exists(fname):
+            x, meta = read_store(fname, columns=columns)
+            return x, np.asarray(meta['mol_id'], dtype=str), np.array(meta['act'], dtype='float64')
+        data = read_descriptors(fname, columns=columns)
+        x = data.drop(['mol_id', 'mol_title', 'act'], axis=1).to_numpy(dtype='float32')
+        return x, data['mol_id'].to_numpy(dtype=str), data['act'].to_numpy(dtype='float64')
+
+    def load_data(self, fname, mol_id, columns=None):
+        start = time.time()
+        x, ids, act = self.read_table(fname, columns=columns)
+        ids = np.array([i.split('__')[0] for i in ids], dtype=str)
+
+        # one pass over the sorted ids: the rows of every mol_id are a contiguous block
+        order = np.argsort(ids, kind='stable')
+        keys, starts = np.unique(ids[order], return_index=True)
+        offsets = np.append(starts, len(order))
+
+        mol_id = np.asarray(mol_id, dtype=str)
+        pos = np.searchsorted(keys, mol_id).clip(max=len(keys) - 1)
+        found = keys[pos] == mol_id
+        if not found.all():
+            # bags must stay aligned with the labels and idx read from the 2d table
+            raise KeyError('{} not found in {}'.format(', '.join(mol_id[~found]), fname))
+
+        rows = PackedBags(order.reshape(-1, 1), offsets).subset(pos)
+        values = x[rows.instances[:, 0]]
+        if sparse.issparse(values):
+            values = values.toarray()
+        bags = PackedBags(np.asarray(values, dtype='float32'), rows.offsets)
+        labels = act[order[starts[pos]]]
+        idx = mol_id.tolist()
+
+        self.load_time[fname] = time.time() - start
+        if self.verbose:
+            print('{}: {} bags, {} instances, {:.2f} s'.format(fname, len(bags), len(ids), self.load_time[fname]))
 
         return bags, labels, idx
 
@@ -68,7 +92,8 @@ class DataReader:
         self.data['dsc']['mil'] = {}
 
         fdir = os.path.join(dsc_dir, self.dataset)
-        for f in os.listdir(fdir):
+        # one name per descriptor set, stored either as csv or as a descriptor store
+        for f in sorted({store_name(f) for f in os.listdir(fdir) if f.endswith(('.csv', '.json'))}):
             if 'tau' in f:
                 alg = 'mil'
             else:
@@ -86,16 +111,19 @@ class DataReader:
 
 def scale_data(X_train, X_test):
     scaler = MinMaxScaler()
-    scaler.fit(np.vstack(X_train))
-    X_train_scaled = X_train.copy()
-    X_test_scaled = X_test.copy()
-    for i, bag in enumerate(X_train):
-        X_train_scaled[i] = scaler.transform(bag)
-    for i, bag in enumerate(X_test):
-        X_test_scaled[i] = scaler.transform(bag)
+    scaler.fit(X_train.instances)
+    X_train_scaled = PackedBags(scaler.transform(X_train.instances).astype('float32'), X_train.offsets)
+    X_test_scaled = PackedBags(scaler.transform(X_test.instances).astype('float32'), X_test.offsets)
     return X_train_scaled, X_test_scaled
 
 
+def train_test_split_bags(bags, labels, idx, test_size=0.2, random_state=45):
+    # the same split as train_test_split(bags, labels, idx), bags stay packed
+    idx_train, idx_test = train_test_split(np.arange(len(bags)), test_size=test_size, random_state=random_state)
+    return (bags.subset(idx_train), bags.subset(idx_test), np.asarray(labels)[idx_train],
+            np.asarray(labels)[idx_test], [idx[i] for i in idx_train], [idx[i] for i in idx_test])
+
+
 def regression_metrics(y_true, y_pred):
     r2 = r2_score(y_true, y_pred)
     rmse = mean_squared_error(y_true, y_pred) ** 0.5
@@ -121,89 +149,99 @@ def classification_metrics(y_true, y_pred, threshold=0.5):
             'tn': tn, 'fp': fp, 'fn': fn, 'tp': tp}
 
 
+_tune_data = {}
+
+
+def set_tune_data(x_train, x_val, y_train, y_val):
+    _tune_data.update(x_train=x_train, x_val=x_val, y_train=y_train, y_val=y_val)
+
+
+def fit_score(params, n_epoch):
+    params = dict(params)
+    net, net_params, tresh = params.pop('net'), params.pop('net_params'), params.pop('tresh')
+    set_seed(params.pop('seed'))
+    net = net(**net_params)
+
+    x_train, x_val, y_train, y_val = (_tune_data[i] for i in ['x_train', 'x_val', 'y_train', 'y_val'])
+    if 'Classifier' in net.__class__.__name__:
+        labels_train = np.where(y_train > tresh, 1, 0)
+        labels_val = np.where(y_val > tresh, 1, 0)
+        net.fit(x_train, labels_train, n_epoch=n_epoch, **params)
+        return classification_metrics(labels_val, net.predict(x_val))['balanced_accuracy']
+
+    net.fit(x_train, y_train, n_epoch=n_epoch, **params)
+    return regression_metrics(y_val, net.predict(x_val))['r2_score']
+
+
 class ModelBuilder:
 
-    def __init__(self, tresh=6.5, init_cuda=False, local_dir='./'):
+    def __init__(self, tresh=6.5, init_cuda=False, local_dir='./', n_jobs=1, n_threads=None):
         self.tresh = tresh
         self.init_cuda = init_cuda
         self.local_dir = local_dir
 
         self.n_epoch = 300
+        self.patience = 50
         self.batch_size = 99999
         self.lr = 0.001
         self.seed = 42
 
+        # successive halving from min_epoch up to n_epoch, n_jobs trials in parallel
+        self.min_epoch = 50
+        self.eta = 3
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads
+
+    # dropout of TempAttentionNet is the softmax temperature, 1 is a plain softmax (0 divides by zero)
+    def trial_params(self, net, net_params, weight_decay=0, dropout=1):
+        return {'net': net, 'net_params': {**net_params, 'init_cuda': self.init_cuda}, 'tresh': self.tresh,
+                'seed': self.seed, 'batch_size': self.batch_size, 'lr': self.lr, 'patience': self.patience,
+                'weight_decay': weight_decay, 'dropout': dropout}
+
     def tune_nets(self, x_train, x_val, y_train, y_val):
-        ndim = (x_train[0].shape[-1], 256, 128, 64)
+        ndim = (x_train.n_dim, 256, 128, 64)
         det_ndim = (64,)
-        set_seed(self.seed)
+        nets = [(TempAttentionNetRegressor, {'ndim': ndim, 'det_ndim': det_ndim})]
+        tuner = Tuner(fit_score, n_epoch=self.n_epoch, min_epoch=self.min_epoch, eta=self.eta, n_jobs=self.n_jobs,
+                      n_threads=self.n_threads, initializer=set_tune_data, initargs=(x_train, x_val, y_train, y_val))
 
         # weight_decay
-        weight_decay_opt = defaultdict(list)
-        for weight_decay in [0, 0.1, 0.01]:
-            for net in [TempAttentionNetRegressor(ndim=ndim, det_ndim=det_ndim, init_cuda=self.init_cuda)]:
-
-                if 'Classifier' in net.name():
-                    labels_train = np.where(y_train > self.tresh, 1, 0)
-                    labels_val = np.where(y_val > self.tresh, 1, 0)
-
-                    net.fit(x_train, labels_train, n_epoch=self.n_epoch, batch_size=self.batch_size,
-                            weight_decay=weight_decay, lr=self.lr)
-
-                    val_scores = classification_metrics(labels_val, net.predict(x_val))
-                    weight_decay_opt[net.name()].append((weight_decay, val_scores['balanced_accuracy']))
-                else:
-                    net.fit(x_train, y_train, n_epoch=self.n_epoch, batch_size=self.batch_size,
-                            weight_decay=weight_decay, lr=self.lr)
-                    val_scores = regression_metrics(y_val, net.predict(x_val))
-                    weight_decay_opt[net.name()].append((weight_decay, val_scores['r2_score']))
+        trials = [(net.__name__, weight_decay, self.trial_params(net, net_params, weight_decay=weight_decay))
+                  for weight_decay in [0, 0.1, 0.01] for net, net_params in nets]
+        weight_decay_opt = tuner.run(trials, log_file=os.path.join(self.local_dir, 'weight_decay_opt.jsonl'))
         #
         hopt = pd.DataFrame()
         for model in weight_decay_opt:
-            print(model)
             hopt['WD'] = [i[0] for i in weight_decay_opt[model]]
             hopt[model] = [i[1] for i in weight_decay_opt[model]]
+            hopt['{}_n_epoch'.format(model)] = [i[2] for i in weight_decay_opt[model]]
         hopt.to_csv(os.path.join(self.local_dir, 'weight_decay_opt.csv'))
         #
-        weight_decay_opt = {k: max(v, key=lambda x: x[1])[0] for k, v in weight_decay_opt.items()}
+        weight_decay_opt = tuner.best(weight_decay_opt)
 
         # dropout
-        dropout_opt = defaultdict(list)
-        for dropout in [0.1, 0.2, 0.4, 0.8, 1, 2]:
-            for net in [TempAttentionNetRegressor(ndim=ndim, det_ndim=det_ndim, init_cuda=self.init_cuda)]:
-
-                if 'Classifier' in net.name():
-                    labels_train = np.where(y_train > self.tresh, 1, 0)
-                    labels_val = np.where(y_val > self.tresh, 1, 0)
-
-                    net.fit(x_train, labels_train, n_epoch=self.n_epoch, batch_size=self.batch_size,
-                            weight_decay=weight_decay_opt[net.name()], dropout=dropout, lr=self.lr)
-
-                    val_scores = classification_metrics(labels_val, net.predict(x_val))
-                    dropout_opt[net.name()].append((dropout, val_scores['balanced_accuracy']))
-                else:
-                    net.fit(x_train, y_train, n_epoch=self.n_epoch, batch_size=self.batch_size,
-                            weight_decay=weight_decay_opt[net.name()], dropout=dropout, lr=self.lr)
-                    val_scores = regression_metrics(y_val, net.predict(x_val))
-                    dropout_opt[net.name()].append((dropout, val_scores['r2_score']))
+        trials = [(net.__name__, dropout, self.trial_params(net, net_params, weight_decay=weight_decay_opt[net.__name__],
+                                                             dropout=dropout))
+                  for dropout in [0.1, 0.2, 0.4, 0.8, 1, 2] for net, net_params in nets]
+        dropout_opt = tuner.run(trials, log_file=os.path.join(self.local_dir, 'dropout_opt.jsonl'))
         #
         hopt = pd.DataFrame()
         for model in dropout_opt:
             hopt['DP'] = [i[0] for i in dropout_opt[model]]
             hopt[model] = [i[1] for i in dropout_opt[model]]
+            hopt['{}_n_epoch'.format(model)] = [i[2] for i in dropout_opt[model]]
         hopt.to_csv(os.path.join(self.local_dir, 'dropout_opt_opt.csv'))
         #
-        dropout_opt = {k: max(v, key=lambda x: x[1])[0] for k, v in dropout_opt.items()}
+        dropout_opt = tuner.best(dropout_opt)
 
         #
-        nets_default = [[k, 0, 0] for k in weight_decay_opt]
-        nets_tuned = [['{}Tuned'.format(k), weight_decay_opt[k], dropout_opt.get(k, 0)] for k in weight_decay_opt]
+        nets_default = [[k, 0, 1] for k in weight_decay_opt]
+        nets_tuned = [['{}Tuned'.format(k), weight_decay_opt[k], dropout_opt.get(k, 1)] for k in weight_decay_opt]
 
         return nets_default, nets_tuned
 
     def train_nets(self, nets_to_train, x_train, x_val, x_test, y_train, y_val, y_test, idx_val, idx_test, mode='3d'):
-
-        ndim = (x_train[0].shape[-1], 256, 128, 64)
+        ndim = (x_train.n_dim, 256, 128, 64)
         det_ndim = (64,)
         set_seed(self.seed)
 
@@ -218,7 +256,7 @@ class ModelBuilder:
 
             #
             model_dir = os.path.join(self.local_dir, model_name)
-            os.mkdir(model_dir)
+            os.makedirs(model_dir, exist_ok=True)
 
             # fit_predict
             if 'Classifier' in net.name():
@@ -227,7 +265,7 @@ class ModelBuilder:
                 labels_test = np.where(y_test > self.tresh, 1, 0)
 
                 net.fit(x_train, labels_train, n_epoch=self.n_epoch, batch_size=self.batch_size,
-                        weight_decay=weight_decay, dropout=dropout, lr=self.lr)
+                        weight_decay=weight_decay, dropout=dropout, lr=self.lr, patience=self.patience)
 
                 train_scores = classification_metrics(labels_train, net.predict(x_train))
                 val_scores = classification_metrics(labels_val, net.predict(x_val))
@@ -235,15 +273,15 @@ class ModelBuilder:
             else:
 
                 net.fit(x_train, y_train, n_epoch=self.n_epoch, batch_size=self.batch_size,
-                        weight_decay=weight_decay, dropout=dropout, lr=self.lr)
+                        weight_decay=weight_decay, dropout=dropout, lr=self.lr, patience=self.patience)
 
                 train_scores = regression_metrics(y_train, net.predict(x_train))
                 val_scores = regression_metrics(y_val, net.predict(x_val))
                 test_scores = regression_metrics(y_test, net.predict(x_test))
             #
-            train_scores = {**{'SIZE': len(y_train)}, **{'MODEL': model_name, 'SET': 'TRAIN'}, **train_scores}
-            val_scores = {**{'SIZE': len(y_val)}, **{'MODEL': model_name, 'SET': 'VAL'}, **val_scores}
-            test_scores = {**{'SIZE': len(y_test)}, **{'MODEL': model_name, 'SET': 'TEST'}, **test_scores}
+            train_scores = {**{'SIZE': len(y_train)}, **{'MODEL': model_name, 'SET': 'TRAIN', 'N_EPOCH': self.n_epoch}, **train_scores}
+            val_scores = {**{'SIZE': len(y_val)}, **{'MODEL': model_name, 'SET': 'VAL', 'N_EPOCH': self.n_epoch}, **val_scores}
+            test_scores = {**{'SIZE': len(y_test)}, **{'MODEL': model_name, 'SET': 'TEST', 'N_EPOCH': self.n_epoch}, **test_scores}
 
             # predictions
             predictions = pd.DataFrame({'TEST_ID': idx_test,
@@ -252,15 +290,18 @@ class ModelBuilder:
             predictions.to_csv(os.path.join(model_dir, 'predictions.csv'))
 
             # results
-            results = results.append([train_scores, val_scores, test_scores])
+            results = pd.concat([results, pd.DataFrame([train_scores, val_scores, test_scores])])
 
             # save model
             #torch.save(net, os.path.join(model_dir, 'model.sav'))
 
+        # rows of retrained models are replaced, so a resumed run does not duplicate them
         csv_file = os.path.join(self.local_dir, 'results.csv')
         if os.path.exists(csv_file):
-            results.to_csv(csv_file, index=False, mode='a', header=False)
-        else:
-            results.to_csv(csv_file, index=False)
+            old = pd.read_csv(csv_file)
+            if not results.empty:
+                old = old[~old['MODEL'].isin(results['MODEL'])]
+            results = pd.concat([old, results])
+        results.to_csv(csv_file, index=False)
 
         return self
\ No newline at end of file